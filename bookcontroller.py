@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import sys
 from collections import OrderedDict
 from documentprocessor import DocumentProcessor
+from pagecache import PageCache
+from bracketsvalidator import BracketsValidator
+from markindex import MarkIndex
+from prefetcher import RenderNotifier
 from paragraphmark import MarkCreator, QRulerMark
 from zonetypes import ZoneIconsProducer
 from cmsquerymodule import CmsQueryCanceledByUser, CourseParseError
+from courseloader import CourseLoader
 
 
 # here main logic is stored. Passed to all views (BookViewerWidget,
@@ -26,7 +33,18 @@ class BookController(object):
     SELECT_DELTA = 12
 
     def __init__(self, toc_controller, cqm, filename=None, mark_creator=None):
-        self.dp = DocumentProcessor(filename, cqm.display_name) \
+        # rendered pages cache is shared by all opened documents, memory
+        # budget (in bytes) can be set in config
+        self.page_cache = PageCache(
+            int(cqm.config_data.get("page-cache-size") or 0))
+        # views connect to it to be repainted when a page is rendered in
+        # background
+        self.render_notifier = RenderNotifier()
+        # show scaled preview until page is rendered in exact scale
+        self.progressive = True
+        self.dp = DocumentProcessor(filename, cqm.display_name,
+                                    self.page_cache,
+                                    self.render_notifier.notify) \
             if filename else None
         self.toc_controller = toc_controller
         self.mc = mark_creator or MarkCreator()
@@ -39,8 +57,16 @@ class BookController(object):
         # IMPORTANT! Mind that this dict doesn't get updated on move()
         # operations -> need to sort elems by y() if want correct order
         self.paragraphs = OrderedDict()
+        # start\end marks sorted by (page, y) for verify_brackets
+        self.brackets_validator = BracketsValidator()
         # a list of all rulers present
         self.rulers = []
+        # start\end mark moved with validation postponed, see move()
+        self._unvalidated_mark = None
+        # MarkIndex'es for searching marks at point: (page, mode) -> marks
+        # on page, "rulers" -> rulers. Built on first search, dropped when
+        # marks are added or deleted, updated when marks change geometry
+        self._mark_indexes = {}
         # zoom scale
         self.scale = 1.0
         # adding start\end or zones
@@ -50,6 +76,12 @@ class BookController(object):
         # only for start\end marks, not rulers
         self.any_unsaved_changes = False
         self.cms_query_module = cqm
+        # (CourseLoader, settings, toc before load) while a course is loading
+        # in background, see load_course
+        self._course_load = None
+        # autozone types changed while course was loading, see
+        # adapt_to_new_settings
+        self._pending_autozone_types = None
         self.settings_changed(cqm.config_data, True)
         # password data has no defaults, have to be created here
         # here login\password is only stored to load in settings dialog.
@@ -79,9 +111,15 @@ class BookController(object):
         # first course or markup load
         if not self._zonetypes:
             self._zonetypes = self.cms_query_module.get_zone_types(
-                self.login, self.password)
+                self.login, self.password, self.cms_course)
         return self._zonetypes
 
+    # zonetypes will be retrieved from ebook-defs again on next access
+    def invalidate_zone_types(self):
+        self.cms_query_module.invalidate_zone_types()
+        self._zonetypes = None
+        self._icons_producer = None
+
     @property
     def current_toc_elem(self):
         return self.toc_controller.active_elem
@@ -131,29 +169,115 @@ class BookController(object):
             self.cms_course = None
         if "cms-course" in new_settings and \
                 self.cms_course != new_settings["cms-course"]:
+            self.cancel_course_load()
             if self.cms_course:
                 self.delete_all()
+            # toc views are filled while course is loading
+            old_toc = getattr(self, "toc_raw", None)
             try:
                 self.toc_raw, self.all_autozones = \
                     self.cms_query_module.get_cms_course_toc(
                         self.login, self.password, new_settings["cms-course"],
-                        progress=progress)
+                        progress=progress,
+                        on_names=self._begin_course,
+                        on_lesson=self.toc_controller.add_lesson)
                 self.cms_course = new_settings["cms-course"]
-                self.toc_controller.reload_course(
-                    self.toc_raw, self.start_autozones, self.end_autozones)
-            except CmsQueryCanceledByUser:
-                self._restore_settings(old_settings)
-                return (False, False)
-            except CourseParseError as e:
-                self._restore_settings(old_settings)
-                self.dp.save_error_log(e.errors, new_settings["cms-course"],
-                                       new_settings["display-name"])
-                return (False, True)
+            except Exception:
+                return self._course_load_failed(
+                    sys.exc_info(), new_settings["cms-course"],
+                    new_settings.get("display-name"), old_settings, old_toc)
 
         if not create_if_none:
             self.adapt_to_new_settings(old_settings, changed)
         return (True, False)
 
+    # Course is loaded in background: lessons appear in toc views as they are
+    # downloaded and can be marked up right away. on_finished(course_loaded,
+    # any_errors) is called when loading is over
+    def load_course(self, course_id, display_name, progress,
+                    on_finished=None):
+        self.cancel_course_load()
+        old_settings = self.book_settings
+        old_toc = getattr(self, "toc_raw", None)
+        if self.cms_course:
+            self.delete_all()
+        # set right away, so that course is not loaded once more if settings
+        # are applied before loading is over
+        self.cms_course = course_id
+        self.display_name = display_name
+        loader = CourseLoader(self.cms_query_module, progress)
+        self._course_load = (loader, old_settings, old_toc)
+
+        def _current(func):
+            # callbacks of a canceled loader still arriving are dropped
+            def _call(*args):
+                if self._course_load and self._course_load[0] is loader:
+                    return func(*args)
+            return _call
+
+        def _finished(result, exc_info):
+            self._course_load = None
+            pending_types = self._pending_autozone_types
+            self._pending_autozone_types = None
+            if exc_info is None:
+                self.toc_raw, self.all_autozones = result
+                if pending_types is not None:
+                    self._replace_autozones(pending_types)
+                status = (True, False)
+            else:
+                try:
+                    status = self._course_load_failed(
+                        exc_info, course_id, display_name, old_settings,
+                        old_toc)
+                except Exception:
+                    if on_finished:
+                        on_finished(False, False)
+                    raise
+            if on_finished:
+                on_finished(*status)
+        loader.start(self.login, self.password, course_id,
+                     on_names=_current(self._begin_course),
+                     on_lesson=_current(self.toc_controller.add_lesson),
+                     on_finished=_current(_finished))
+
+    # stops background loading of a course and brings back the previous one
+    def cancel_course_load(self):
+        if not self._course_load:
+            return
+        loader, old_settings, old_toc = self._course_load
+        self._course_load = None
+        self._pending_autozone_types = None
+        loader.cancel()
+        self.delete_all()
+        self._restore_settings(old_settings)
+        self._restore_toc(old_toc)
+
+    def _begin_course(self, toc):
+        self.toc_controller.begin_course(toc, self.start_autozones,
+                                         self.end_autozones)
+
+    # brings back previous course after a failed load. Returns
+    # (course_loaded, any_errors) for errors user is told about, anything
+    # else is re-raised
+    def _course_load_failed(self, exc_info, course_id, display_name,
+                            old_settings, old_toc):
+        # marks might have been placed on lessons already loaded
+        self.delete_all()
+        self._restore_settings(old_settings)
+        self._restore_toc(old_toc)
+        error = exc_info[1]
+        if isinstance(error, CmsQueryCanceledByUser):
+            return (False, False)
+        if isinstance(error, CourseParseError):
+            self.dp.save_error_log(error.errors, course_id, display_name)
+            return (False, True)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    # brings back toc of previous course after a failed load
+    def _restore_toc(self, old_toc):
+        self.toc_controller.reload_course(old_toc or [], self.start_autozones,
+                                          self.end_autozones)
+
     def adapt_to_new_settings(self, old, new):
         # adapt to margin type change
         if "margins" in new:
@@ -174,6 +298,15 @@ class BookController(object):
         for key in ["start-autozones", "end-autozones", "passthrough-zones"]:
             if key in new:
                 delete_types.update(new[key])
+        if self._course_load:
+            # markup elems of a course still loading are incomplete, zones are
+            # reloaded when loading is over
+            self._pending_autozone_types = \
+                (self._pending_autozone_types or set()) | delete_types
+            return
+        self._replace_autozones(delete_types)
+
+    def _replace_autozones(self, delete_types):
         zone_parent = None
         for auto_type in delete_types:
             for cas_id in self.paragraph_marks:
@@ -341,16 +474,35 @@ class BookController(object):
             return self.dp.totalPages
         return 0
 
-    def load_course(self, course_id, display_name, progress):
-        return self.settings_changed({"cms-course": course_id,
-                                      "display-name": display_name},
-                                     progress=progress)
-
     def get_image(self):
         if not self.dp:
             return None
+        if self.progressive:
+            return self.dp.curr_page_progressive(self.scale)
         return self.dp.curr_page(self.scale)
 
+    # at high zoom page is rendered and shown by tiles
+    def is_tiled(self):
+        return self.dp is not None and self.dp.is_tiled(self.scale)
+
+    # returns a list of (target QRect, QImage, source QRect) to be drawn in
+    # order to show part of the current page given by QRect rect
+    def get_tiles(self, rect):
+        if not self.dp:
+            return []
+        return self.dp.curr_page_tiles(self.scale, rect, self.progressive)
+
+    # size of current page in current scale, doesn't require rendering
+    def get_page_size(self):
+        if not self.dp:
+            return None
+        return self.dp.page_size(self.scale)
+
+    # True if page num (1st page has number 1) rendered in given scale is the
+    # one currently shown
+    def is_current_image(self, num, scale):
+        return num == self.pagenum and scale == self.scale
+
     # returns start\end marks and zones visible on page page_num in this mode
     # doesn't care about rulers
     def get_page_marks(self, page_num, mode):
@@ -362,6 +514,18 @@ class BookController(object):
         except KeyError:
             return []
 
+    # marks, zones and rulers to be painted on current page
+    def get_visible_marks(self):
+        return [m for m in self._get_all_page_marks(self.pagenum) + self.rulers
+                if m.is_visible]
+
+    # start\end marks and zones on page regardless of mode
+    def _get_all_page_marks(self, page_num):
+        if page_num not in self.paragraphs:
+            return []
+        return self.paragraphs[page_num]["marks"] + \
+            self.paragraphs[page_num]["zones"]
+
     def get_start_end_marks(self, page_num):
         try:
             return self.paragraphs[page_num]["marks"]
@@ -451,8 +615,14 @@ class BookController(object):
         self.delete_all()
         # deselect all in toc list
         self.toc_controller.set_default_style()
+        # pages of previous document are of no use any more
+        if self.dp:
+            self.dp.close()
+        self.page_cache.invalidate()
         try:
-            self.dp = DocumentProcessor(filename, self.display_name)
+            self.dp = DocumentProcessor(filename, self.display_name,
+                                        self.page_cache,
+                                        self.render_notifier.notify)
             return True
         except Exception as e:
             print e.message
@@ -471,15 +641,20 @@ class BookController(object):
     # here marks_parent is a parent widget to set at marks' creation
     def load_markup(self, filename, marks_parent, progress=None):
         self.delete_all()
-        paragraphs, settings = self.dp.load_native_xml(filename)
+        # markup is read paragraph by paragraph, settings come first
+        markup = self.dp.iter_native_xml(filename)
+        _, settings, _ = next(markup)
         course_loaded, any_errors = self.settings_changed(settings,
                                                           progress=progress)
         if not course_loaded:
+            markup.close()
             return False
         # generate start\end marks from paragraphs' data
         if progress:
-            progress.setRange(0, len(paragraphs.items()) - 1)
-        for i, (cas_id, data) in enumerate(paragraphs.items()):
+            progress.setRange(0, os.path.getsize(filename))
+        for _, (cas_id, data), pos in markup:
+            if progress:
+                progress.setValue(pos)
             marks = data["marks"]
             zones = data["zones"]
             for m in marks:
@@ -491,11 +666,10 @@ class BookController(object):
                              "page": page,
                              "delete_func": self.delete_funcs["start_end"],
                              "type": m["type"],
-                             "corrections": self._get_corrections()}
-                mark = self.add_mark(mark_data)
-                mark.adjust(self.scale)
-                if mark.page != self.pagenum:
-                    mark.hide()
+                             "corrections": self._get_corrections(),
+                             # marks are painted when their page is shown
+                             "hidden": page != self.pagenum}
+                mark = self.add_mark(mark_data, scale=1.0)
             # now generate zones
             for z in zones:
                 page = int(z["page"])
@@ -519,7 +693,7 @@ class BookController(object):
                              "corrections": self._get_corrections(
                                  z["at"], z["rubric"]),
                              "recalc_corrections": self._recalc_corrections}
-                zone = self.add_zone(zone_data)
+                zone = self.add_zone(zone_data, scale=1.0)
                 if self.is_markup_mode and zone.should_show(self.pagenum):
                     zone.show()
                 else:
@@ -543,9 +717,9 @@ class BookController(object):
         # correct page order
         for pagenum in sorted(self.paragraphs.keys()):
             for m in sorted(self.paragraphs[pagenum]["marks"],
-                            key=lambda m: m.y()):
+                            key=lambda m: m.pdf_y()):
                 para_key = m.cas_id
-                y = self.transform_to_pdf_coords(m.y())
+                y = m.pdf_y()
                 mark = {"page": m.page,
                         "name": m.name,
                         "y": y}
@@ -556,7 +730,6 @@ class BookController(object):
                                                 "zones": []}
         for cas_id in self.paragraph_marks.keys():
             for z in self.paragraph_marks[cas_id]["zones"]:
-                y = self.transform_to_pdf_coords(z.y())
                 pdf_paragraphs[cas_id]["zones"].append(z.to_dict())
 
         # pass first page orientation
@@ -574,17 +747,19 @@ class BookController(object):
     # add zone to zones on page zone.page AND to paragraph's zones
     # There might be no marks on pages, so have to check on pagenum's presence
     # in self.paragraphs' keys
-    def add_zone(self, zone_data):
+    def add_zone(self, zone_data, scale=None):
         def _add_to_page(pagenum):
             if pagenum not in self.paragraphs.keys():
                 self._add_new_page(pagenum)
             self.paragraphs[pagenum]["zones"].append(zone)
         zone = self.mc.make_zone_mark(**zone_data)
+        self._init_mark(zone, scale)
         # if zone is a passthrough one, then add it to all it's pages
         if not zone.pass_through:
             _add_to_page(zone.page)
         else:
             map(lambda p: _add_to_page(p), zone.pages)
+        self._drop_page_indexes()
         # situation with paragraph_marks is different: zones can't be placed
         # unless paragraph has start and end mark -> no check here
         # TODO
@@ -599,7 +774,7 @@ class BookController(object):
     # by 1. Otherwise - scale will be taken from delta: delta + old if delta
     # in [MIN, MAX], or not taken if out of bounds
     def zoom(self, delta, step_by_step=True):
-        new_scale = old_scale = self.scale
+        new_scale = self.scale
         if step_by_step:
             if delta > 0:
                 new_scale = self.scale + self.ZOOM_DELTA
@@ -609,16 +784,13 @@ class BookController(object):
             new_scale = delta + self.scale
         if new_scale >= self.MIN_SCALE and new_scale <= self.MAX_SCALE:
             self.scale = new_scale
-            coeff = new_scale / old_scale
-            # have to adjust ALL items including rulers
-            for cas_id in self.paragraph_marks.keys():
-                markslist = list(self.paragraph_marks[cas_id]["marks"]) + \
-                    self.paragraph_marks[cas_id]["zones"]
-                for m in markslist:
-                    m.adjust(coeff)
-            # now rulers
-            for r in self.get_rulers():
-                r.adjust(coeff)
+            # only marks on current page and rulers are projected to new
+            # scale, the rest are when their page is shown
+            for m in self._get_all_page_marks(self.pagenum) + self.rulers:
+                m.set_scale(self.scale)
+            # pages prefetched in old scale are useless now
+            if self.dp:
+                self.dp.prefetch(self.scale)
         return self.scale
 
     def autozones(self, zone_parent, progress=None):
@@ -633,12 +805,14 @@ class BookController(object):
                 if self.is_zone_placed(cas_id, az["zone-id"]):
                     continue
                 self.any_unsaved_changes = True
-                pos = (0, start.y())
+                # positions are in pdf coordinates, marks of other pages
+                # might be in other scale
+                pos = (0, start.pdf_y())
                 if az["rel-start"]:
-                    pos = (0, az["rel-start"] * self.scale + start.y())
+                    pos = (0, az["rel-start"] + start.pdf_y())
                 elif az["rel-end"]:
                     # substract relative end from end-of-page y
-                    pos = (0, end.y() + az["rel-end"] * self.scale)
+                    pos = (0, end.pdf_y() + az["rel-end"])
                 # autozones are bound to START\END, not PAGE NUM in oid!
                 page = start.page if az["rubric"] in self.start_autozones \
                     else end.page
@@ -652,7 +826,7 @@ class BookController(object):
                     # that page!
                     pages = range(start.page, end.page)
                     # figure out whether should add last page
-                    if end.y() > pos_y:
+                    if end.pdf_y() > pos_y:
                         pages.append(end.page)
                     pages = dict(zip(pages, [pos_y]*len(pages)))
                 zone_data = {"pos": pos,
@@ -671,7 +845,7 @@ class BookController(object):
                              "pass_through": pass_through,
                              "recalc_corrections": self._recalc_corrections,
                              "pages": pages}
-                zone = self.add_zone(zone_data)
+                zone = self.add_zone(zone_data, scale=1.0)
                 count = count + 1
                 if zone.should_show(self.pagenum):
                     zone.show()
@@ -700,6 +874,8 @@ class BookController(object):
             map(lambda m: m.hide(), self.paragraphs[pagenum]["marks"])
 
     def show_page_marks(self, pagenum):
+        for m in self._get_all_page_marks(pagenum):
+            m.set_scale(self.scale)
         show_marks = []
         if pagenum in self.paragraphs.keys():
             show_marks = self.paragraphs[pagenum]["marks"]
@@ -711,25 +887,30 @@ class BookController(object):
         map(lambda m: m.show(), show_marks)
 
     def transform_to_pdf_coords(self, coord_value):
-        img = self.dp.curr_page()
-        if img is None:
+        if not self.dp:
             return 0
         return coord_value / self.scale
 
     # here 1st page has number 1
     def go_to_page(self, pagenum):
+        self._mark_indexes = {}
         # hide selections on this page
         self.hide_page_marks(self.pagenum)
         # show selections on page we are switching to
         self.show_page_marks(pagenum)
-        return self.dp.go_to_page(pagenum - 1)
+        changed = self.dp.go_to_page(pagenum - 1)
+        if changed:
+            self.dp.prefetch(self.scale)
+        return changed
 
     def find_course(self, name_part, login, password):
         return self.cms_query_module.search_for_course(name_part, login,
                                                        password)
 
-    # move all currently selected elems
-    def move(self, delta, point_tuple):
+    # move all currently selected elems. Validation of a moved start\end
+    # mark (and toc state update) can be postponed with validate=False till
+    # validate_moved() is called, e.g. when dragging stops
+    def move(self, delta, point_tuple, validate=True):
         # if only one mark is selected at a time, the check whether we want to
         # bind it to a ruler
         if len(self.selected_marks) == 1:
@@ -738,29 +919,18 @@ class BookController(object):
             # check if there are any rulers at point
             mark = self.selected_marks[0]
             # TODO here point is passed as a QPoint, have to convert to tuple
-            ruler = self.find_at_point(point_tuple,
-                                       self.get_rulers())
+            ruler = self.find_ruler_at_point(point_tuple)
             self.any_unsaved_changes = True
             if ruler:
-                mark.bind_to_ruler(ruler)
+                self.bind_to_ruler(mark, ruler)
             else:
                 # no ruler should be assigned to mark
                 mark.unbind_from_ruler()
                 mark.move(delta)
-                # after mark is moved verify that start comes before end,
-                # otherwise set error state
-                other_mark = self.get_next_paragraph_mark(self.operational_mode,
-                                                          mark)
-                if other_mark and other_mark != mark:
-                    start = mark if mark.is_start() else other_mark
-                    end = other_mark if start == mark else mark
-                    toc_elem = self.toc_controller.get_elem(mark.cas_id,
-                                                            self.operational_mode)
-                    is_ok = self.verify_start_end(start, end)
-                    (ok_braces, error) = self.verify_brackets()
-                    self.toc_controller.set_state(True, mark.cas_id,
-                                                  not is_ok,
-                                                  not ok_braces)
+                self.brackets_validator.update(mark)
+                self._unvalidated_mark = mark
+                if validate:
+                    self.validate_moved()
             return
         # else move as usual
         delta_x, delta_y = delta
@@ -770,6 +940,7 @@ class BookController(object):
             self.any_unsaved_changes = True
             for m in self.selected_marks:
                 m.move(delta)
+                self.brackets_validator.update(m)
         # if rulers become invisible after move -> delete them
         for r in self.selected_rulers:
             r.move(delta)
@@ -778,15 +949,38 @@ class BookController(object):
                 r.delete()
                 r.destroy()
 
+    # after mark is moved verify that start comes before end, otherwise set
+    # error state
+    def validate_moved(self):
+        mark = self._unvalidated_mark
+        self._unvalidated_mark = None
+        if not mark or mark not in self.brackets_validator:
+            return
+        other_mark = self.get_next_paragraph_mark(self.operational_mode, mark)
+        if other_mark and other_mark != mark:
+            start = mark if mark.is_start() else other_mark
+            end = other_mark if start == mark else mark
+            is_ok = self.verify_start_end(start, end)
+            (ok_braces, error) = self.verify_brackets()
+            self.toc_controller.set_state(True, mark.cas_id,
+                                          not is_ok,
+                                          not ok_braces)
+
+    def bind_to_ruler(self, mark, ruler):
+        mark.bind_to_ruler(ruler)
+        self.brackets_validator.update(mark)
+
     def delete_all(self):
         for cas_id in self.paragraph_marks.keys():
             self.delete_marks(marks=self.paragraph_marks[cas_id]["marks"])
             self.toc_controller.set_default_state(cas_id)
         self.paragraphs = {}
+        self.brackets_validator.clear()
         # destroy previous rulers
         for r in self.rulers:
             r.destroy()
         self.rulers = []
+        self._mark_indexes = {}
 
     def delete_all_zones(self):
         for cas_id in self.paragraph_marks:
@@ -814,6 +1008,7 @@ class BookController(object):
                     m.remove_page(m.page)
             elif m.is_start() or m.is_end():
                 self.paragraphs[m.page]["marks"].remove(m)
+                self.brackets_validator.remove(m)
                 # remove all placed zones as well if any mark removed
                 for z in self.paragraph_marks[m.cas_id]["zones"]:
                     for page in z.pages:
@@ -826,6 +1021,7 @@ class BookController(object):
             if m.delete():
                 m.destroy()
                 deleted = deleted + 1
+        self._drop_page_indexes()
         return deleted
 
     ### callbacks to be passed to Mark Widgets
@@ -859,17 +1055,21 @@ class BookController(object):
 
     def delete_ruler(self, ruler):
         self.rulers.remove(ruler)
+        self._mark_indexes.pop("rulers", None)
         return True
 
     # create and add to global rulers a new ruler
     def add_ruler(self, ruler_data):
         ruler = self.mc.make_ruler_mark(**ruler_data)
+        self._init_mark(ruler)
         self.rulers.append(ruler)
+        self._mark_indexes.pop("rulers", None)
         return ruler
 
     # add mark to a correct place (start comes first, end - second)
-    def add_mark(self, mark_data):
+    def add_mark(self, mark_data, scale=None):
         mark = self.mc.make_paragraph_mark(**mark_data)
+        self._init_mark(mark, scale)
         self._add_paragraph_mark(mark)
         try:
             (start, end) = self.paragraph_marks[mark.cas_id]["marks"]
@@ -901,21 +1101,28 @@ class BookController(object):
             self.toc_controller.set_state(False, mark.cas_id)
         return mark
 
+    # searches among marks on current page unless among is given
     def find_at_point(self, point_tuple, among=None):
+        if among is None:
+            return self._find_in_index(point_tuple, self._get_mark_index(
+                (self.pagenum, self.operational_mode)))
         # in order to be a bit more user-friendly, first search precisely at
         # point clicked, then add some delta and search withing +-delta area
-        page_marks = self.get_current_page_marks() if among is None else among
         exact_match = next(
-            (mark for mark in page_marks if mark.contains(point_tuple)), None)
+            (mark for mark in among if mark.contains(point_tuple)), None)
         if exact_match:
             return exact_match
         else:
-            x, y = point_tuple
-            rect_tuple = (x - self.SELECT_DELTA, y - self.SELECT_DELTA,
-                          x + self.SELECT_DELTA, y + self.SELECT_DELTA)
-            return next((mark for mark in page_marks
+            rect_tuple = self._select_rect(point_tuple)
+            return next((mark for mark in among
                          if mark.intersects(rect_tuple)), None)
 
+    def find_ruler_at_point(self, point_tuple):
+        if not self.get_rulers():
+            return None
+        return self._find_in_index(point_tuple,
+                                   self._get_mark_index("rulers"))
+
     # find any selected mark at point, either a paragraph mark or a ruler
     # point (section mode) or any zone (marker mode)
     def find_any_at_point(self, point_tuple):
@@ -923,7 +1130,7 @@ class BookController(object):
         if selected_mark:
             return selected_mark
         else:
-            return self.find_at_point(point_tuple, self.get_rulers())
+            return self.find_ruler_at_point(point_tuple)
 
     # returns True if all marked paragraphs have both start and end marks in
     # the correct order (start mark goes first).
@@ -947,28 +1154,48 @@ class BookController(object):
     # check that no paragraph begins in between other paragraph's start and end
     # the solution is similar to (({}()))()) brackets validation problem so
     # called the same
-    # returns (True, None) and (False, error_mark)
+    # returns (True, None) and (False, error_mark). Only pages changed since
+    # previous check are looked at, see BracketsValidator
     def verify_brackets(self):
-        stack = []
-        for pagenum in sorted(self.paragraphs.keys()):
-            for m in sorted(self.paragraphs[pagenum]["marks"],
-                            key=lambda m:m.y()):
-                if m.is_start():
-                    stack.append(m.cas_id)
-                    continue
-                elif m.is_end():
-                    try:
-                        if stack[-1] != m.cas_id:
-                            return (False, m)
-                        else:
-                            stack.pop()
-                    except IndexError:
-                        return (False, m)
-        # as braces check can be done when all paragraphs have both marks,
-        # count will be always = 0
-        return (True, None)
+        return self.brackets_validator.validate()
 
     ### helper functions
+    def _select_rect(self, point_tuple):
+        x, y = point_tuple
+        return (x - self.SELECT_DELTA, y - self.SELECT_DELTA,
+                x + self.SELECT_DELTA, y + self.SELECT_DELTA)
+
+    # same as find_at_point, but marks are looked up in index
+    def _find_in_index(self, point_tuple, index):
+        exact_match = index.find_at_point(point_tuple)
+        if exact_match:
+            return exact_match
+        return index.find_in_rect(self._select_rect(point_tuple))
+
+    # key is (page, mode) or "rulers"
+    def _get_mark_index(self, key):
+        if key not in self._mark_indexes:
+            marks = self.rulers if key == "rulers" \
+                else self.get_page_marks(*key)
+            self._mark_indexes[key] = MarkIndex(marks)
+        return self._mark_indexes[key]
+
+    # marks' lists on pages have changed, rulers' index stays
+    def _drop_page_indexes(self):
+        for key in self._mark_indexes.keys():
+            if key != "rulers":
+                del self._mark_indexes[key]
+
+    # mark_data's positions are in given scale, current one if None
+    def _init_mark(self, mark, scale=None):
+        mark.set_origin_scale(scale or self.scale)
+        mark.set_scale(self.scale)
+        mark.on_geometry_changed = self._mark_geometry_changed
+
+    def _mark_geometry_changed(self, mark):
+        for index in self._mark_indexes.values():
+            index.update(mark)
+
     def _add_new_paragraph(self, cas_id):
         self.paragraph_marks[cas_id] = {"marks": None,
                                         "zones": []}
@@ -1037,7 +1264,7 @@ class BookController(object):
         pagenum = pagenum or self.pagenum
         (pos_x, pos_y) = pos
         if self.has_both_margins():
-            if pos_x <= self.get_image().width() / 2:
+            if pos_x <= self.get_page_size().width() / 2:
                 return "l"
             else:
                 return "r"
@@ -1073,10 +1300,10 @@ class BookController(object):
         else:
             delta = (self.margin_width - width) / 2
             if margin == "r" and self.has_both_margins():
-                return (self.margin_width + self.get_image().width() + delta,
-                        0)
+                return (self.margin_width + self.get_page_size().width() +
+                        delta, 0)
             if margin == "r":
-                return (self.get_image().width() + delta, 0)
+                return (self.get_page_size().width() + delta, 0)
             return (delta, 0)
 
     # add paragraph mark to paragraph_marks (without duplicates)
@@ -1087,3 +1314,5 @@ class BookController(object):
         except KeyError:
             self.paragraphs[mark.page] = {"marks": [mark],
                                           "zones": []}
+        self.brackets_validator.add(mark)
+        self._drop_page_indexes()
@@ -26,6 +26,8 @@ class BookViewerWidget(QtGui.QMainWindow, Ui_MainWindow):
         self.last_zoom_index = 0
         self.last_open_doc_name = None
         self.pageNum = 1
+        # see update_chrome
+        self._last_chrome_state = None
         # after widgets initiation pass view's name to toccontroller
         self.toc_controller = toc_controller
         self.toc_controller.set_views(self.listView, self.treeView)
@@ -223,6 +225,9 @@ class BookViewerWidget(QtGui.QMainWindow, Ui_MainWindow):
         self.imageLabel.connect(self.imageLabel,
                                 QtCore.SIGNAL("zoomChanged(float)"),
                                 self.on_zoom_changed)
+        notifier = self.controller.render_notifier
+        notifier.connect(notifier, notifier.rendered_signal,
+                         self.on_page_rendered)
         self.zoom_comboBox.connect(self.zoom_comboBox,
                                    QtCore.SIGNAL("currentIndexChanged(int)"),
                                    self.on_zoom_value_change)
@@ -398,6 +403,11 @@ class BookViewerWidget(QtGui.QMainWindow, Ui_MainWindow):
         self.last_zoom_index = self.controller.get_current_zoom_index()
         self.zoom_comboBox.setCurrentIndex(self.last_zoom_index)
 
+    # page has been rendered in background, repaint if it is the one shown
+    def on_page_rendered(self, num, scale):
+        if self.controller.is_current_image(num + 1, scale):
+            self.imageLabel.update()
+
     def on_zoom_value_change(self):
         # calc delta, set widgets data and call zoom
         current = self.zoom_comboBox.currentIndex()
@@ -609,6 +619,24 @@ class BookViewerWidget(QtGui.QMainWindow, Ui_MainWindow):
 
     def update(self):
         super(BookViewerWidget, self).update()
+        self.update_chrome()
+
+    # everything console and actions' states depend on
+    def _chrome_state(self):
+        file_given = self.controller.is_file_given()
+        return (self.mode, self.toc_controller.state_version,
+                self.controller.cms_course is not None, file_given,
+                file_given and self.controller.selected_marks_and_rulers != [],
+                file_given and self.controller.any_changes,
+                self.last_open_doc_name is not None)
+
+    # refreshes console and enables\disables actions, only if anything they
+    # depend on has changed since last refresh. Called on every paint of page
+    def update_chrome(self):
+        state = self._chrome_state()
+        if state == self._last_chrome_state:
+            return
+        self._last_chrome_state = state
         # update console data
         # TODO it might not be here, think of a better place
         self.update_console_data()
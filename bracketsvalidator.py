@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from bisect import bisect_left, insort
+
+
+# Checks that no paragraph begins in between other paragraph's start and end
+# (the same as (({}()))()) brackets validation) without rescanning the whole
+# book every time a mark is added, moved or deleted.
+#
+# Marks are kept sorted by (page, y). Every page is reduced to a summary:
+# ends that close paragraphs started on previous pages, an error found inside
+# the page and starts left open. Only summaries of changed pages are
+# recomputed, and the pass over summaries starts at the first changed page
+# and stops as soon as open paragraphs after a page are the same as they were
+# before the change.
+#
+# Marks are anything with page, cas_id, pdf_y(), is_start() and is_end().
+# Position is taken in pdf coordinates, so marks don't move on zoom, and is
+# read when mark is added or updated: update() has to be called after a mark
+# has been moved.
+class BracketsValidator(object):
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # sorted numbers of pages with marks
+        self._pages = []
+        # page -> marks sorted by (y, seq) and a parallel list of those keys
+        self._marks = {}
+        self._keys = {}
+        # mark -> (page, y, seq). seq is the order marks were added in, so
+        # marks with the same y go in the order they appear in page's list
+        self._key_of = {}
+        self._seq = 0
+        # page -> (ends closing earlier paragraphs, error mark, open starts)
+        self._summaries = {}
+        # page -> cas_ids of paragraphs still open after that page, valid
+        # for pages before the first changed one
+        self._after = {}
+        # pages changed since last validate()
+        self._dirty = set()
+        # (page, error mark) or None
+        self._error = None
+
+    def __contains__(self, mark):
+        return mark in self._key_of
+
+    def add(self, mark):
+        if mark in self._key_of:
+            return self.update(mark)
+        self._seq = self._seq + 1
+        self._insert(mark, self._seq)
+
+    def remove(self, mark):
+        key = self._key_of.pop(mark, None)
+        if key is None:
+            return
+        page = key[0]
+        keys = self._keys[page]
+        i = bisect_left(keys, key[1:])
+        del keys[i]
+        del self._marks[page][i]
+        if not keys:
+            del self._keys[page]
+            del self._marks[page]
+            del self._pages[bisect_left(self._pages, page)]
+            self._after.pop(page, None)
+        self._touch(page)
+
+    # re-reads mark's position, has to be called after every move
+    def update(self, mark):
+        key = self._key_of.get(mark)
+        if key is None or key[:2] == (mark.page, mark.pdf_y()):
+            return
+        self.remove(mark)
+        self._insert(mark, key[2])
+
+    # returns (True, None) and (False, error_mark), same as a full scan of
+    # all marks in (page, y) order would
+    def validate(self):
+        if not self._dirty:
+            return self._result()
+        first_dirty = min(self._dirty)
+        # nothing changed before the first error -> it is still there
+        if self._error and self._error[0] < first_dirty:
+            return self._result()
+        start = bisect_left(self._pages, first_dirty)
+        if start > 0 and self._pages[start - 1] not in self._after:
+            start = 0
+        stack = list(self._after[self._pages[start - 1]]) if start > 0 else []
+        last_dirty = max(self._dirty)
+        self._dirty = set()
+        for i in xrange(start, len(self._pages)):
+            page = self._pages[i]
+            (ends, page_error, starts) = self._summary(page)
+            error = None
+            for m in ends:
+                if not stack or stack[-1] != m.cas_id:
+                    error = m
+                    break
+                stack.pop()
+            error = error or page_error
+            if error:
+                self._error = (page, error)
+                for p in self._pages[i:]:
+                    self._after.pop(p, None)
+                return self._result()
+            stack.extend(starts)
+            after = tuple(stack)
+            # the rest of the book is the same as during previous check
+            if page >= last_dirty and self._after.get(page) == after:
+                return self._result()
+            self._after[page] = after
+        self._error = None
+        return self._result()
+
+    def _result(self):
+        if self._error:
+            return (False, self._error[1])
+        return (True, None)
+
+    def _insert(self, mark, seq):
+        page = mark.page
+        key = (mark.pdf_y(), seq)
+        if page not in self._keys:
+            insort(self._pages, page)
+            self._keys[page] = []
+            self._marks[page] = []
+        keys = self._keys[page]
+        i = bisect_left(keys, key)
+        keys.insert(i, key)
+        self._marks[page].insert(i, mark)
+        self._key_of[mark] = (page,) + key
+        self._touch(page)
+
+    def _touch(self, page):
+        self._summaries.pop(page, None)
+        self._dirty.add(page)
+
+    def _summary(self, page):
+        if page not in self._summaries:
+            self._summaries[page] = self._summarize(self._marks[page])
+        return self._summaries[page]
+
+    @staticmethod
+    def _summarize(marks):
+        ends = []
+        starts = []
+        for m in marks:
+            if m.is_start():
+                starts.append(m.cas_id)
+            elif m.is_end():
+                if not starts:
+                    # closes a paragraph from previous pages
+                    ends.append(m)
+                elif starts[-1] != m.cas_id:
+                    return (ends, m, ())
+                else:
+                    starts.pop()
+        return (ends, None, tuple(starts))
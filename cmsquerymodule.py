@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import pycurl
 import urllib
 import os
 import json
+import time
 from json import dumps, loads
-from StringIO import StringIO
 from lxml import etree
 from lxml.builder import ElementMaker
+from curlpool import CurlPool
+from httpcache import HttpCache
+from coursesnapshot import save_snapshot, load_snapshot
 from zonetypes import DEFAULT_ZONE_TYPES, PASS_THROUGH_ZONES, START_AUTOZONES, \
     END_AUTOZONES
 
@@ -53,11 +55,32 @@ class ZoneTypeError(CourseParseError):
 
 class CmsQueryModule(object):
     DEFAULT_CONFIG = "config"
+    DEFAULT_MAX_CONNECTIONS = 8
+    # seconds zonetypes from ebook-defs are considered fresh
+    DEFAULT_ZONE_TYPES_TTL = 600
+    DEFAULT_HTTP_CACHE_DIR = "~/.sectiontool/http-cache"
+    # seconds a course snapshot is served instead of querying cms
+    DEFAULT_SNAPSHOT_TTL = 86400
+    # lesson ids resolved by one request
+    DEFAULT_RESOLVE_BATCH_SIZE = 100
+    RESOLVE_RETRIES = 3
+    # seconds before first retry, doubled every next one
+    RESOLVE_BACKOFF = 0.5
+    # worth retrying: network errors (0), timeouts and server overload
+    TRANSIENT_CODES = [0, 408, 429, 500, 502, 503, 504]
 
     def __init__(self, config_filename=None):
         self.config_data = {}
         self.parse_config(config_filename or self.DEFAULT_CONFIG)
         self.display_name = None
+        # login -> (time retrieved, zonetypes)
+        self._zone_types_cache = {}
+        self._curl_pool = None
+        # course id -> course loaded from a snapshot (see coursesnapshot),
+        # served without querying cms till it is older than snapshot-ttl
+        self._snapshots = {}
+        # (course_id, toc, autozone types) of the last course loaded
+        self._last_course = None
 
     @property
     def any_course_data(self):
@@ -95,26 +118,37 @@ class CmsQueryModule(object):
                 'login': u'',
                 'password': u''}
 
-    def _fetch_data(self, url, login, password):
-        # for some alternatively talented people who have russian
-        # usernames\passwords (everything might happen)
-        login = login.encode('utf-8')
-        password = password.encode('utf-8')
-        storage = StringIO()
-        c = pycurl.Curl()
-        c.setopt(pycurl.URL, url)
-        c.setopt(pycurl.USERPWD, login + ":" + password)
-        # TODO find out how to use certificate
-        c.setopt(pycurl.SSL_VERIFYPEER, 0)
-        c.setopt(pycurl.SSL_VERIFYHOST, 0)
-        c.setopt(c.WRITEFUNCTION, storage.write)
-        c.perform()
-        code = c.getinfo(pycurl.HTTP_CODE)
-        data = None
-        if code == 200:
-            data = storage.getvalue()
-        c.close()
-        return (code, data)
+    # how many lessons are downloaded simultaneously
+    @property
+    def max_connections(self):
+        return int(self.config_data.get("max-connections") or
+                   self.DEFAULT_MAX_CONNECTIONS)
+
+    # all requests to cms go through it, connections are kept alive
+    @property
+    def curl_pool(self):
+        if not self._curl_pool:
+            self._curl_pool = CurlPool(
+                self.max_connections,
+                int(self.config_data.get("timeout") or 0),
+                int(self.config_data.get("connect-timeout") or 0),
+                self.config_data.get("http2") in ["1", "true", "yes"],
+                HttpCache(os.path.expanduser(
+                    self.config_data.get("http-cache-dir") or
+                    self.DEFAULT_HTTP_CACHE_DIR)))
+        return self._curl_pool
+
+    # cached documents (course and lessons) are kept on disk and revalidated
+    # with conditional requests
+    def _fetch_data(self, url, login, password, cached=False):
+        return self.curl_pool.fetch(url, login, password, cached=cached)
+
+    # fetches all urls concurrently, see CurlPool.fetch_many
+    def _fetch_many(self, urls, login, password, on_fetched=None,
+                    cached=False):
+        return self.curl_pool.fetch_many(urls, login, password,
+                                         on_fetched=on_fetched,
+                                         cached=cached)
 
     def validate_user_data(self, login, password):
         url = self.config_data['ping-url'].rstrip('/')
@@ -134,8 +168,17 @@ class CmsQueryModule(object):
         return [(elem["display_name"], urllib.unquote(elem["encoded_name"]))
                 for elem in data["documents"]]
 
-    # retrieve available zonetypes from ebook-defs
-    def get_zone_types(self, login, password):
+    # retrieve available zonetypes from ebook-defs. Result is memoized per
+    # login for zone-types-ttl seconds, so that ebook-defs is downloaded once
+    # per course load at most. Zonetypes saved in a snapshot of course_id are
+    # used while it is fresh
+    def get_zone_types(self, login, password, course_id=None):
+        snapshot = self._get_snapshot(course_id)
+        if snapshot and snapshot["zone-types"]:
+            return snapshot["zone-types"]
+        cached = self._zone_types_cache.get(login)
+        if cached and time.time() - cached[0] < self.zone_types_ttl:
+            return cached[1]
         defs_url = self.config_data['url'].rstrip('/') + '/object:ebook-defs'
         code, data = self._fetch_data(defs_url, login, password)
         all_zones = []
@@ -144,67 +187,147 @@ class CmsQueryModule(object):
             all_zones = etree.fromstring(data).\
                 xpath(TYPE_XPATH, namespaces=NSMAP)
         if not data or all_zones == []:
+            # not cached, ebook-defs may be available next time
             return self._defaults["zonetypes"]
+        self._zone_types_cache[login] = (time.time(), all_zones)
+        return all_zones
+
+    # forget zonetypes retrieved earlier (for given login or for everyone)
+    def invalidate_zone_types(self, login=None):
+        if login is None:
+            self._zone_types_cache.clear()
         else:
-            return all_zones
+            self._zone_types_cache.pop(login, None)
+
+    @property
+    def zone_types_ttl(self):
+        return int(self.config_data.get("zone-types-ttl") or
+                   self.DEFAULT_ZONE_TYPES_TTL)
+
+    @property
+    def snapshot_ttl(self):
+        return int(self.config_data.get("snapshot-ttl") or
+                   self.DEFAULT_SNAPSHOT_TTL)
+
+    @property
+    def resolve_batch_size(self):
+        return int(self.config_data.get("resolve-batch-size") or
+                   self.DEFAULT_RESOLVE_BATCH_SIZE)
+
+    # returns a dict {id: name}. Ids are resolved by batches, sent
+    # concurrently; batches failed because of network errors or server
+    # overload are retried with exponential backoff. Canceled progress stops
+    # resolving after the batch being fetched
+    def _resolve_lesson_names(self, ids, login, password, progress=None):
+        size = self.resolve_batch_size
+        batches = [ids[i:i + size] for i in range(0, len(ids), size)]
+        resolved = {}
+        delay = self.RESOLVE_BACKOFF
 
-    def _resolve_names(self, lesson_ids, progress, login, password):
+        def _check_canceled(*args):
+            if progress and progress.wasCanceled():
+                progress.close()
+                raise CmsQueryCanceledByUser()
+        for attempt in range(self.RESOLVE_RETRIES + 1):
+            if attempt > 0:
+                _check_canceled()
+                time.sleep(delay)
+                delay = delay * 2
+            results = self.curl_pool.fetch_many(
+                [self.config_data["resolve-url"]] * len(batches),
+                login, password,
+                bodies=[dumps(batch) for batch in batches],
+                headers=['Content-Type : application/json; charset=UTF-8'],
+                on_fetched=_check_canceled, raise_errors=False)
+            failed = []
+            for batch, (code, content) in zip(batches, results):
+                if code == 200:
+                    resolved.update(loads(content))
+                elif code in self.TRANSIENT_CODES:
+                    failed.append(batch)
+                else:
+                    raise CmsQueryError("Could not resolve lesson names!")
+            if not failed:
+                return resolved
+            batches = failed
+        raise CmsQueryError("Could not resolve lesson names!")
+
+    # on_names(toc) is called as soon as lesson names are resolved (toc has
+    # no objects yet), on_lesson(i, lesson) - every time next lesson in TOC
+    # order has been downloaded and parsed
+    def _resolve_names(self, lesson_ids, progress, login, password,
+                       on_names=None, on_lesson=None):
         ids_to_resolve = ["lesson:" + lesson_id
                           for lesson_id in lesson_ids]
-        body = dumps(ids_to_resolve)
-        storage = StringIO()
-        c = pycurl.Curl()
-        c.setopt(pycurl.URL, self.config_data["resolve-url"])
-        c.setopt(pycurl.HTTPHEADER,
-                 ['Content-Type : application/json; charset=UTF-8'])
-        c.setopt(c.WRITEFUNCTION, storage.write)
-        c.setopt(pycurl.POST, 1)
-        c.setopt(pycurl.POSTFIELDS, body)
-        c.setopt(pycurl.USERPWD, "{}:{}".format(login, password))
-        c.perform()
-        resp = c.getinfo(pycurl.HTTP_CODE)
-        c.close()
-        content = None
-        if resp == 200:
-            content = storage.getvalue()
-        if resp.status != 200:
-            raise CmsQueryError("Could not resolve lesson names!")
-        resolved = loads(content)
-        toc = []
+        resolved = self._resolve_lesson_names(ids_to_resolve, login,
+                                              password, progress)
+        toc = [{"name": resolved[lesson_id],
+                "cas-id": lesson_id,
+                "objects": []}
+               for lesson_id in ids_to_resolve]
+        if on_names:
+            on_names(toc)
         errors = []
+        zone_types = self.get_zone_types(login, password)
         if progress:
             progress.setRange(0, len(ids_to_resolve))
-        any_errors = False
-        for i, lesson_id in enumerate(ids_to_resolve):
+        # lessons downloaded but not parsed yet, by TOC index
+        fetched = {}
+        # lessons are downloaded concurrently, but parsed in TOC order
+        parsed = [0]
+
+        def _on_fetched(count, i, result):
+            fetched[i] = result
+            while parsed[0] in fetched:
+                j = parsed[0]
+                code, data = fetched.pop(j)
+                objects, lesson_errors = self._parse_lesson_objects(
+                    ids_to_resolve[j], data, zone_types)
+                errors.extend(lesson_errors)
+                toc[j]["objects"] = objects
+                parsed[0] = j + 1
+                if on_lesson:
+                    on_lesson(j, toc[j])
             if progress:
-                progress.setValue(i)
+                progress.setValue(count)
                 if progress.wasCanceled():
                     progress.close()
                     raise CmsQueryCanceledByUser()
-            objects, lesson_errors = self._get_lesson_objects(
-                lesson_id, login, password,
-                self.get_zone_types(login, password))
-            if lesson_errors != []:
-                any_errors = True
-                errors.extend(lesson_errors)
-            toc.append(
-                {"name": resolved[lesson_id],
-                 "cas-id": lesson_id,
-                 "objects": objects})
-        if any_errors:
+        self._fetch_many([self._lesson_url(lesson_id)
+                          for lesson_id in ids_to_resolve],
+                         login, password, _on_fetched, cached=True)
+        if errors:
             raise CourseParseError("Check course contents for errors!",
                                    errors=errors)
         return toc
 
-    # returns a list of {name, cas-id} in order of appearance in TOC
+    # calls streaming callbacks for a course that is loaded at once
+    def _notify_loaded(self, toc, on_names, on_lesson):
+        if on_names:
+            on_names([{"name": lesson["name"],
+                       "cas-id": lesson["cas-id"],
+                       "objects": []} for lesson in toc])
+        if on_lesson:
+            for i, lesson in enumerate(toc):
+                on_lesson(i, lesson)
+
+    # returns a list of {name, cas-id} in order of appearance in TOC.
+    # Course can be consumed while it is loading, see _resolve_names for
+    # on_names and on_lesson
     def get_cms_course_toc(self, login, password, course_id=None,
-                           progress=None):
+                           progress=None, on_names=None, on_lesson=None):
         if not self.any_course_data and not course_id:
             return []
         course_id = course_id or self.config_data['cms-course']
+        snapshot = self._get_snapshot(course_id)
+        if snapshot:
+            self.display_name = snapshot["display-name"]
+            self._notify_loaded(snapshot["toc"], on_names, on_lesson)
+            return (snapshot["toc"], snapshot["autozone-types"])
         course_url = os.path.join(self.config_data['url'],
                                   course_id.encode('utf-8'))
-        code, data = self._fetch_data(course_url, login, password)
+        code, data = self._fetch_data(course_url, login, password,
+                                      cached=True)
         if data:
             if progress:
                 progress.setLabelText(u"Загрузка курса из cms...")
@@ -213,12 +336,55 @@ class CmsQueryModule(object):
             self.display_name = tree.xpath(
                 "/is:course/@display-name", namespaces=NSMAP)[0]
             lesson_ids = tree.xpath(TOC_XPATH, namespaces=NSMAP)
-            toc = self._resolve_names(lesson_ids, progress, login, password)
+            toc = self._resolve_names(lesson_ids, progress, login, password,
+                                      on_names, on_lesson)
             auto_types = self._get_autozone_types(toc)
+            self._last_course = (course_id, toc, auto_types)
+            if self.config_data.get("snapshot-dir"):
+                self.export_snapshot(
+                    self._snapshot_name(self.config_data["snapshot-dir"],
+                                        course_id), login, password)
             return (toc, auto_types)
         else:
             raise CmsQueryError("Check your url and user\password settings")
 
+    # saves the last course loaded to a snapshot file
+    def export_snapshot(self, filename, login, password):
+        if not self._last_course:
+            raise CmsQueryError("No course has been loaded yet!")
+        course_id, toc, auto_types = self._last_course
+        return save_snapshot(filename, course_id, self.display_name, toc,
+                             auto_types,
+                             self.get_zone_types(login, password, course_id))
+
+    # course from snapshot will be returned by get_cms_course_toc for its
+    # course id without querying cms, till snapshot is older than
+    # snapshot-ttl. Returns course id
+    def load_snapshot(self, filename):
+        snapshot = load_snapshot(filename)
+        self._snapshots[snapshot["course-id"]] = snapshot
+        self.display_name = snapshot["display-name"]
+        self._last_course = (snapshot["course-id"], snapshot["toc"],
+                             snapshot["autozone-types"])
+        return snapshot["course-id"]
+
+    # snapshot of course if it is fresh, stale ones are dropped so that
+    # course is loaded from cms again
+    def _get_snapshot(self, course_id):
+        snapshot = self._snapshots.get(course_id)
+        if snapshot and \
+                time.time() - snapshot["created"] >= self.snapshot_ttl:
+            del self._snapshots[course_id]
+            return None
+        return snapshot
+
+    def _snapshot_name(self, directory, course_id):
+        directory = os.path.expanduser(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return os.path.join(directory,
+                            course_id.replace(':', '_') + ".sqlite")
+
     def _get_autozone_types(self, toc):
         result = set()
 
@@ -235,9 +401,16 @@ class CmsQueryModule(object):
                     result.add(zone_type)
         return list(result)
 
+    def _lesson_url(self, lesson_id):
+        return os.path.join(self.config_data['url'], lesson_id)
+
     def _get_lesson_objects(self, lesson_id, login, password, zone_types):
-        lesson_url = os.path.join(self.config_data['url'], lesson_id)
-        code, data = self._fetch_data(lesson_url, login, password)
+        code, data = self._fetch_data(self._lesson_url(lesson_id), login,
+                                      password, cached=True)
+        return self._parse_lesson_objects(lesson_id, data, zone_types)
+
+    # returns (objects, errors) parsed from lesson xml
+    def _parse_lesson_objects(self, lesson_id, data, zone_types):
         errors = []
         if data:
             PARAGRAPHS_XPATH = \
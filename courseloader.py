@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import threading
+from PyQt4 import QtCore
+
+
+# Stands for a progress dialog in loading thread. Calls are re-emitted as
+# signals and reach the dialog in GUI thread through the event loop,
+# cancellation is a flag set from GUI thread
+class ProgressProxy(QtCore.QObject):
+    def __init__(self, progress=None):
+        super(ProgressProxy, self).__init__()
+        self._canceled = threading.Event()
+        self.range_signal = QtCore.SIGNAL("rangeChanged(int, int)")
+        self.value_signal = QtCore.SIGNAL("valueChanged(int)")
+        self.label_signal = QtCore.SIGNAL("labelTextChanged(QString)")
+        if progress:
+            self.connect(self, self.range_signal,
+                         progress, QtCore.SLOT("setRange(int, int)"))
+            self.connect(self, self.value_signal,
+                         progress, QtCore.SLOT("setValue(int)"))
+            self.connect(self, self.label_signal,
+                         progress, QtCore.SLOT("setLabelText(QString)"))
+            self.connect(progress, QtCore.SIGNAL("canceled()"), self.cancel)
+
+    def setRange(self, minimum, maximum):
+        self.emit(self.range_signal, minimum, maximum)
+
+    def setValue(self, value):
+        self.emit(self.value_signal, value)
+
+    def setLabelText(self, text):
+        self.emit(self.label_signal, text)
+
+    def wasCanceled(self):
+        return self._canceled.is_set()
+
+    # dialog is closed by the one who has shown it
+    def close(self):
+        pass
+
+    def cancel(self):
+        self._canceled.set()
+
+
+# Loads a course (see CmsQueryModule.get_cms_course_toc) in a background
+# thread, so that lessons already downloaded can be marked up while the rest
+# of the course is loading. Callbacks are called in GUI thread, in order:
+# on_names(toc), on_lesson(i, lesson) for every lesson, and finally
+# on_finished(result, exc_info), where result is (toc, autozone types) and
+# exc_info is None if course has been loaded, sys.exc_info() of the error
+# otherwise
+class CourseLoader(QtCore.QObject):
+    def __init__(self, cqm, progress=None):
+        super(CourseLoader, self).__init__()
+        self.cqm = cqm
+        self.progress = ProgressProxy(progress)
+        self.names_signal = QtCore.SIGNAL("namesResolved(PyQt_PyObject)")
+        self.lesson_signal = QtCore.SIGNAL(
+            "lessonLoaded(int, PyQt_PyObject)")
+        self.finished_signal = QtCore.SIGNAL(
+            "finished(PyQt_PyObject, PyQt_PyObject)")
+        self._thread = None
+
+    # callbacks are connected here, in GUI thread, and are delivered there
+    def start(self, login, password, course_id, on_names, on_lesson,
+              on_finished):
+        self.connect(self, self.names_signal, on_names)
+        self.connect(self, self.lesson_signal, on_lesson)
+        self.connect(self, self.finished_signal, on_finished)
+        self._thread = threading.Thread(
+            target=self._load, args=(login, password, course_id),
+            name="course-loader")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # loading stops after the lesson being downloaded now, on_finished gets
+    # CmsQueryCanceledByUser
+    def cancel(self):
+        self.progress.cancel()
+
+    def _load(self, login, password, course_id):
+        try:
+            result = self.cqm.get_cms_course_toc(
+                login, password, course_id, progress=self.progress,
+                # lessons are filled in loading thread later, so GUI thread
+                # gets copies
+                on_names=lambda toc: self.emit(
+                    self.names_signal, [dict(lesson) for lesson in toc]),
+                on_lesson=lambda i, lesson: self.emit(
+                    self.lesson_signal, i, dict(lesson)))
+        except Exception:
+            self.emit(self.finished_signal, None, sys.exc_info())
+        else:
+            self.emit(self.finished_signal, result, None)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import time
+import sqlite3
+
+# bumped every time schema changes, snapshots of other versions are not read
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+    CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE lessons (position INTEGER PRIMARY KEY,
+                          cas_id TEXT NOT NULL,
+                          name TEXT);
+    CREATE TABLE objects (lesson INTEGER NOT NULL,
+                          position INTEGER NOT NULL,
+                          oid TEXT,
+                          block_id TEXT,
+                          rubric TEXT,
+                          name TEXT,
+                          PRIMARY KEY (lesson, position));
+    CREATE TABLE zone_types (kind TEXT NOT NULL,
+                             position INTEGER NOT NULL,
+                             name TEXT NOT NULL,
+                             PRIMARY KEY (kind, position));
+"""
+
+# kinds of zone types stored
+AUTOZONE_TYPES = "auto"
+# zone types from ebook-defs
+DEFINED_ZONE_TYPES = "defs"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# Course snapshot is a single SQLite file with everything loaded from cms
+# for a course: display name, toc with lesson objects, autozone types and
+# zone types from ebook-defs. Loading it takes a few queries instead of
+# downloading and parsing hundreds of xmls.
+def save_snapshot(filename, course_id, display_name, toc, autozone_types,
+                  zone_types):
+    # snapshot is written aside and replaces the old one at once
+    tmp_name = filename + ".tmp"
+    if os.path.exists(tmp_name):
+        os.remove(tmp_name)
+    conn = sqlite3.connect(tmp_name)
+    try:
+        conn.executescript(SCHEMA)
+        conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                         [("course-id", course_id),
+                          ("display-name", display_name),
+                          ("created", str(int(time.time())))])
+        conn.executemany("INSERT INTO lessons VALUES (?, ?, ?)",
+                         [(i, lesson["cas-id"], lesson["name"])
+                          for i, lesson in enumerate(toc)])
+        conn.executemany("INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                         [(i, j, obj["oid"], obj["block-id"],
+                           obj.get("rubric"), obj.get("name"))
+                          for i, lesson in enumerate(toc)
+                          for j, obj in enumerate(lesson["objects"])])
+        conn.executemany("INSERT INTO zone_types VALUES (?, ?, ?)",
+                         [(kind, i, name)
+                          for kind, names in
+                          [(AUTOZONE_TYPES, autozone_types),
+                           (DEFINED_ZONE_TYPES, zone_types)]
+                          for i, name in enumerate(names)])
+        conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        conn.commit()
+    finally:
+        conn.close()
+    os.rename(tmp_name, filename)
+    return filename
+
+
+# returns a dict with "course-id", "display-name", "toc", "autozone-types",
+# "zone-types" and "created" (unix time), toc is in the same format as the
+# one retrieved from cms
+def load_snapshot(filename):
+    if not os.path.isfile(filename):
+        raise SnapshotError(u"No such snapshot: %s" % filename)
+    conn = sqlite3.connect(filename)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            raise SnapshotError(u"Unsupported snapshot version %d" % version)
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        toc = [{"cas-id": cas_id, "name": name, "objects": []}
+               for cas_id, name in conn.execute(
+                   "SELECT cas_id, name FROM lessons ORDER BY position")]
+        for lesson, oid, block_id, rubric, name in conn.execute(
+                "SELECT lesson, oid, block_id, rubric, name FROM objects "
+                "ORDER BY lesson, position"):
+            toc[lesson]["objects"].append({"oid": oid,
+                                           "block-id": block_id,
+                                           "rubric": rubric,
+                                           "name": name})
+        zone_types = {AUTOZONE_TYPES: [], DEFINED_ZONE_TYPES: []}
+        for kind, name in conn.execute(
+                "SELECT kind, name FROM zone_types ORDER BY kind, position"):
+            zone_types[kind].append(name)
+    except sqlite3.DatabaseError as e:
+        raise SnapshotError(u"Broken snapshot %s: %s" % (filename, e))
+    finally:
+        conn.close()
+    return {"course-id": meta.get("course-id"),
+            "display-name": meta.get("display-name"),
+            "toc": toc,
+            "autozone-types": zone_types[AUTOZONE_TYPES],
+            "zone-types": zone_types[DEFINED_ZONE_TYPES],
+            "created": int(meta.get("created") or 0)}
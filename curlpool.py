@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import pycurl
+from StringIO import StringIO
+
+
+# Keeps curl handles between requests. A handle remembers connections it has
+# opened, so requests to the same host reuse them (no TCP and TLS handshake
+# every time). Handles share DNS and TLS session caches as well.
+class CurlPool(object):
+    DEFAULT_MAX_CONNECTIONS = 8
+    # seconds
+    DEFAULT_TIMEOUT = 60
+    DEFAULT_CONNECT_TIMEOUT = 15
+
+    # http_cache (HttpCache) is used for requests made with cached=True
+    def __init__(self, max_connections=None, timeout=None,
+                 connect_timeout=None, http2=False, http_cache=None):
+        self.http_cache = http_cache
+        self.max_connections = max_connections or \
+            self.DEFAULT_MAX_CONNECTIONS
+        self.timeout = timeout or self.DEFAULT_TIMEOUT
+        self.connect_timeout = connect_timeout or self.DEFAULT_CONNECT_TIMEOUT
+        # http2 lets all requests to a host go through one connection, used
+        # only if libcurl supports it
+        self.http2 = http2 and hasattr(pycurl, "CURL_HTTP_VERSION_2_0")
+        self._idle = []
+        self._lock = threading.Lock()
+        self._share = pycurl.CurlShare()
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        if hasattr(pycurl, "LOCK_DATA_SSL_SESSION"):
+            self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    # returns (http code, response body or None if code is not 200). Cached
+    # GET requests are revalidated if there is a cached response, 304 is
+    # returned as 200 with cached body
+    def fetch(self, url, login, password, body=None, headers=None,
+              cached=False):
+        c, transfer = self._start(url, login, password, body, headers,
+                                  cached)
+        try:
+            c.perform()
+            return self._finish(c, transfer)
+        finally:
+            self._release(c)
+
+    # fetches all urls concurrently, no more than max_connections at a time.
+    # bodies (if given) are POSTed, one for every url. Returns a list of
+    # (code, data) in order of urls. on_fetched(count, i, (code, data)) is
+    # called every time one more url (urls[i]) is fetched, an exception
+    # raised there stops fetching.
+    # Network errors are raised as pycurl.error, unless raise_errors is False:
+    # then failed requests get code 0
+    def fetch_many(self, urls, login, password, bodies=None, headers=None,
+                   on_fetched=None, cached=False, raise_errors=True):
+        results = [None] * len(urls)
+        bodies = bodies or [None] * len(urls)
+        waiting = list(reversed(list(enumerate(zip(urls, bodies)))))
+        # curl handle -> (url index, transfer)
+        active = {}
+        fetched = 0
+        multi = pycurl.CurlMulti()
+        if self.http2 and hasattr(pycurl, "M_PIPELINING"):
+            # CURLPIPE_MULTIPLEX
+            multi.setopt(pycurl.M_PIPELINING, 2)
+        try:
+            while waiting or active:
+                while waiting and len(active) < self.max_connections:
+                    i, (url, body) = waiting.pop()
+                    c, transfer = self._start(url, login, password, body,
+                                              headers, cached)
+                    active[c] = (i, transfer)
+                    multi.add_handle(c)
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    num_queued, ok_list, err_list = multi.info_read()
+                    for c, errno, errmsg in err_list:
+                        if raise_errors:
+                            # same as failed perform() of a single request
+                            raise pycurl.error(errno, errmsg)
+                        i, transfer = active.pop(c)
+                        results[i] = (0, None)
+                        multi.remove_handle(c)
+                        self._release(c)
+                        fetched = fetched + 1
+                        if on_fetched:
+                            on_fetched(fetched, i, results[i])
+                    for c in ok_list:
+                        i, transfer = active.pop(c)
+                        results[i] = self._finish(c, transfer)
+                        multi.remove_handle(c)
+                        self._release(c)
+                        fetched = fetched + 1
+                        if on_fetched:
+                            on_fetched(fetched, i, results[i])
+                    if num_queued == 0:
+                        break
+                if active:
+                    multi.select(1.0)
+        finally:
+            for c in active:
+                multi.remove_handle(c)
+                self._release(c)
+            multi.close()
+        return results
+
+    def close(self):
+        with self._lock:
+            for c in self._idle:
+                c.close()
+            self._idle = []
+
+    # returns (handle, transfer), transfer is a dict with everything needed
+    # to process response
+    def _start(self, url, login, password, body, headers, cached):
+        cached = cached and self.http_cache is not None and body is None
+        transfer = {"url": url,
+                    "login": login,
+                    "cached": cached,
+                    "storage": StringIO(),
+                    "headers": {}}
+        headers = list(headers or [])
+        if cached:
+            headers.extend(self.http_cache.conditional_headers(url, login))
+        c = self._acquire(url, login, password, transfer["storage"], body,
+                          headers)
+
+        def _on_header(line):
+            # status line starts a new response (after redirect etc)
+            if line.startswith("HTTP/"):
+                transfer["headers"] = {}
+            elif ":" in line:
+                name, value = line.split(":", 1)
+                transfer["headers"][name.strip().lower()] = value.strip()
+        c.setopt(pycurl.HEADERFUNCTION, _on_header)
+        return c, transfer
+
+    def _finish(self, c, transfer):
+        code = c.getinfo(pycurl.HTTP_CODE)
+        data = transfer["storage"].getvalue() if code == 200 else None
+        if transfer["cached"]:
+            if code == 304:
+                data = self.http_cache.get(transfer["url"], transfer["login"])
+                if data is not None:
+                    code = 200
+            elif code == 200:
+                self.http_cache.put(transfer["url"], transfer["login"],
+                                    transfer["headers"], data)
+        return (code, data)
+
+    # returns an idle handle (or a new one) set up for request
+    def _acquire(self, url, login, password, storage, body=None,
+                 headers=None):
+        with self._lock:
+            c = self._idle.pop() if self._idle else None
+        if c is None:
+            c = pycurl.Curl()
+        else:
+            # options are dropped, open connections are kept
+            c.reset()
+        # for some alternatively talented people who have russian
+        # usernames\passwords (everything might happen)
+        if isinstance(login, unicode):
+            login = login.encode('utf-8')
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        c.setopt(pycurl.SHARE, self._share)
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.USERPWD, login + ":" + password)
+        # TODO find out how to use certificate
+        c.setopt(pycurl.SSL_VERIFYPEER, 0)
+        c.setopt(pycurl.SSL_VERIFYHOST, 0)
+        # lesson xmls compress well
+        c.setopt(pycurl.ENCODING, "gzip, deflate")
+        c.setopt(pycurl.TIMEOUT, self.timeout)
+        c.setopt(pycurl.CONNECTTIMEOUT, self.connect_timeout)
+        # timeouts are implemented with signals otherwise
+        c.setopt(pycurl.NOSIGNAL, 1)
+        if hasattr(pycurl, "TCP_KEEPALIVE"):
+            c.setopt(pycurl.TCP_KEEPALIVE, 1)
+        if self.http2:
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2_0)
+            if hasattr(pycurl, "PIPEWAIT"):
+                c.setopt(pycurl.PIPEWAIT, 1)
+        if headers:
+            c.setopt(pycurl.HTTPHEADER, headers)
+        if body is not None:
+            c.setopt(pycurl.POST, 1)
+            c.setopt(pycurl.POSTFIELDS, body)
+        c.setopt(pycurl.WRITEFUNCTION, storage.write)
+        return c
+
+    def _release(self, c):
+        with self._lock:
+            if len(self._idle) < self.max_connections:
+                self._idle.append(c)
+                return
+        c.close()
@@ -1,41 +1,84 @@
 # -*- coding: utf-8 -*-
 import os
+import stat
+import tempfile
+from array import array
+from io import BytesIO
 from PyQt4 import QtCore
-from popplerqt4 import Poppler
 from lxml import etree
 from lxml.builder import ElementMaker
 from zonetypes import DEFAULT_ZONE_TYPES
 from cmsquerymodule import NSMAP
+from pagecache import PageCache
+from previews import PreviewGenerator
+from prefetcher import PagePrefetcher, load_document, render_page, \
+    render_tile, tile_rect, TILE_SIZE
 
 XHTML_NAMESPACE = "http://internet-school.ru/abc"
 
 E = ElementMaker(namespace=XHTML_NAMESPACE, nsmap=NSMAP)
 
 
+# qualified name of a tag in markup namespace
+def _tag(name):
+    return "{%s}%s" % (XHTML_NAMESPACE, name)
+
+
+# line break followed by indentation of given depth, as in pretty printed xml
+def _newline(level):
+    return "\n" + "  " * level
+
+
+# sets whitespace text and tails of elem subtree as pretty printing would,
+# elem being at given depth in the document
+def _indent(elem, level):
+    if len(elem) and not (elem.text and elem.text.strip()):
+        elem.text = _newline(level + 1)
+        for child in elem:
+            _indent(child, level + 1)
+            child.tail = _newline(level + 1)
+        child.tail = _newline(level)
+
+
 class LoaderError(Exception):
     def __str__(self):
         return self.message.encode("utf-8")
 
 
 class DocumentProcessor(object):
-    resolution = 72.0
-
-    def __init__(self, filename, display_name):
+    # scale of a quick render shown while the exact one is in progress
+    PREVIEW_SCALE = 1.0
+    # starting from this scale pages are rendered by tiles, only visible ones
+    TILED_SCALE = 2.5
+    # tiles that are that close to the visible area are rendered in background
+    TILE_MARGIN = TILE_SIZE / 2
+
+    # on_rendered(num, scale) is called from a worker thread every time a page
+    # has been rendered in background
+    def __init__(self, filename, display_name, page_cache=None,
+                 on_rendered=None):
         self.filename = filename
         self.display_name = display_name
         self.curr_page_num = 0
-        # map of maps: rendered_pages in all possible scales
-        self.rendered_pages = {}
+        # rendered pages in all possible scales, keyed by (page, scale)
+        self.page_cache = page_cache or PageCache()
+        # ((page, scale), scaled image) shown until exact render is ready
+        self._placeholder = (None, None)
         print u"filename is %s" % filename
         # check that file exists (in case app is run from console)
         # if error log exists -> remove it
         if os.path.isfile("errors.log"):
             os.remove("errors.log")
         if os.path.isfile(filename):
-            self.doc = Poppler.Document.load(filename)
-            self.doc.setRenderHint(Poppler.Document.TextAntialiasing)
+            self.doc = load_document(filename)
         else:
             raise LoaderError(u"No such file: %s" % filename)
+        # sizes of all pages in scale 1, so that no page has to be rendered
+        # just to learn its dimensions
+        self.page_widths, self.page_heights = self._index_page_sizes()
+        # renders neighbouring pages in background
+        self.prefetcher = PagePrefetcher(filename, self.page_cache,
+                                         on_rendered=on_rendered)
 
     # 0 for first page
     @property
@@ -52,23 +95,35 @@ class DocumentProcessor(object):
             return 0
         return self.doc.numPages()
 
-    def width(self, scale=1):
-        return self.curr_page(scale).width()
+    # width of page num (current one if not given) in given scale
+    def width(self, scale=1, num=None):
+        num = self.curr_page_num if num is None else num
+        return int(self.page_widths[num] * scale)
 
-    def height(self, scale=1):
-        return self.curr_page(scale).height()
+    def height(self, scale=1, num=None):
+        num = self.curr_page_num if num is None else num
+        return int(self.page_heights[num] * scale)
 
     # returns a QImage
     def render_page(self, num, scale):
-        page = self.doc.page(num)
-        qimage = page.renderToImage(self.resolution * scale,
-                                    self.resolution * scale,
-                                    0,
-                                    0,
-                                    page.pageSize().width() * scale,
-                                    page.pageSize().height() * scale,
-                                    0)
-        return qimage
+        return render_page(self.doc, num, scale)
+
+    # start rendering pages around the current one in given scale
+    def prefetch(self, scale):
+        if self.is_tiled(scale):
+            # whole pages are never rendered in such a scale, tiles around
+            # the visible area are requested on painting
+            self.prefetcher.cancel()
+        else:
+            self.prefetcher.schedule(self.curr_page_num, scale,
+                                     self.totalPages)
+
+    def is_tiled(self, scale):
+        return scale >= self.TILED_SCALE
+
+    # stop background rendering, has to be called before document is dropped
+    def close(self):
+        self.prefetcher.shutdown()
 
     def next_page(self):
         self.curr_page_num = self.curr_page_num + 1 \
@@ -82,23 +137,115 @@ class DocumentProcessor(object):
         return self.curr_page()
 
     # here 1st page is passed as page 0
+    # returns True if page has been changed, nothing is rendered here
     def go_to_page(self, pagenum):
         self.curr_page_num = pagenum \
-            if pagenum in range(0, self.totalPages) else self.curr_page_num
-        return self.curr_page() if self.curr_page_num == pagenum else None
+            if 0 <= pagenum < self.totalPages else self.curr_page_num
+        return self.curr_page_num == pagenum
 
     def curr_page(self, scale=1):
-        # if page has already been rendered -> take from rendered dict
-        if self.curr_page_num in self.rendered_pages.keys():
-            # search for prerendered scale
-            page_scales = self.rendered_pages[self.curr_page_num]
-            if scale not in page_scales.keys():
-                self.rendered_pages[self.curr_page_num][scale] = \
-                    self.render_page(self.curr_page_num, scale)
-        else:
-            rendered = self.render_page(self.curr_page_num, scale)
-            self.rendered_pages[self.curr_page_num] = {scale: rendered}
-        return self.rendered_pages[self.curr_page_num][scale]
+        # if page has already been rendered -> take it from cache
+        num = self.curr_page_num
+        return self.page_cache.get_or_render(
+            (num, scale), lambda: self.render_page(num, scale))
+
+    # returns current page in given scale if it has already been rendered,
+    # otherwise returns quickly any lower-resolution version of it scaled to
+    # the same size and renders exact one in background
+    def curr_page_progressive(self, scale=1):
+        num = self.curr_page_num
+        image = self.page_cache.get((num, scale))
+        if image is not None:
+            self._placeholder = (None, None)
+            return image
+        placeholder_key, placeholder = self._placeholder
+        if placeholder_key == (num, scale):
+            # job might have been canceled by prefetcher since (page
+            # changes, zoom), requests of a pending job are ignored
+            self.prefetcher.request(num, scale)
+            return placeholder
+        scales = self.page_cache.scales(num)
+        # the most detailed of lower scales, if none - the closest larger one
+        lower = [s for s in scales if s < scale]
+        preview_scale = max(lower) if lower else min(scales or [None])
+        if preview_scale is None:
+            if scale <= self.PREVIEW_SCALE:
+                return self.curr_page(scale)
+            preview_scale = self.PREVIEW_SCALE
+        preview = self.page_cache.get_or_render(
+            (num, preview_scale),
+            lambda: self.render_page(num, preview_scale))
+        self.prefetcher.request(num, scale)
+        size = self.page_size(scale, num)
+        placeholder = preview.scaled(size, QtCore.Qt.IgnoreAspectRatio,
+                                     QtCore.Qt.FastTransformation)
+        self._placeholder = ((num, scale), placeholder)
+        return placeholder
+
+    # returns a list of (target QRect, QImage, source QRect) covering visible
+    # part of current page (rect, a QRect in page coordinates) in given scale.
+    # Tiles that haven't been rendered yet are substituted with a part of
+    # low-resolution page if progressive, tiles around visible area are
+    # rendered in background
+    def curr_page_tiles(self, scale, rect, progressive=True):
+        num = self.curr_page_num
+        size = self.page_size(scale, num)
+        page_rect = QtCore.QRect(QtCore.QPoint(0, 0), size)
+        visible = rect.intersected(page_rect)
+        around = rect.adjusted(-self.TILE_MARGIN, -self.TILE_MARGIN,
+                               self.TILE_MARGIN, self.TILE_MARGIN).\
+            intersected(page_rect)
+        result = []
+        if visible.isEmpty():
+            return result
+        for (col, row) in self._tiles_in(visible):
+            x, y, w, h = tile_rect(size.width(), size.height(), col, row)
+            target = QtCore.QRect(x, y, w, h)
+            key = (num, scale, col, row)
+            tile = self.page_cache.get(key)
+            if tile is not None:
+                result.append((target, tile, QtCore.QRect(0, 0, w, h)))
+            elif progressive:
+                self.prefetcher.request_tile(num, scale, col, row, True)
+                preview = self.page_cache.get_or_render(
+                    (num, self.PREVIEW_SCALE),
+                    lambda: self.render_page(num, self.PREVIEW_SCALE))
+                ratio = self.PREVIEW_SCALE / scale
+                source = QtCore.QRect(int(x * ratio), int(y * ratio),
+                                      max(1, int(w * ratio)),
+                                      max(1, int(h * ratio)))
+                result.append((target, preview, source))
+            else:
+                tile = self.page_cache.put(
+                    key, render_tile(self.doc, num, scale, col, row))
+                result.append((target, tile, QtCore.QRect(0, 0, w, h)))
+        visible_tiles = set(self._tiles_in(visible))
+        for (col, row) in self._tiles_in(around):
+            if (col, row) not in visible_tiles:
+                self.prefetcher.request_tile(num, scale, col, row)
+        return result
+
+    # returns (col, row) of all tiles intersecting rect
+    def _tiles_in(self, rect):
+        return [(col, row)
+                for row in range(rect.top() / TILE_SIZE,
+                                 rect.bottom() / TILE_SIZE + 1)
+                for col in range(rect.left() / TILE_SIZE,
+                                 rect.right() / TILE_SIZE + 1)]
+
+    # returns QSize of page num (current one if not given) rendered in given
+    # scale, nothing is rendered here
+    def page_size(self, scale=1, num=None):
+        return QtCore.QSize(self.width(scale, num), self.height(scale, num))
+
+    def _index_page_sizes(self):
+        widths = array("i")
+        heights = array("i")
+        for i in range(0, self.doc.numPages()):
+            size = self.doc.page(i).pageSize()
+            widths.append(size.width())
+            heights.append(size.height())
+        return widths, heights
 
     # selection is a QRect
     def get_text(self, selection):
@@ -110,15 +257,40 @@ class DocumentProcessor(object):
     # bookviewer as self.paragraphs)
     # filename = name of file with markup, NOT pdf
     def load_native_xml(self, filename):
-        tree = etree.parse(filename)
-        SETTINGS_XPATH = "/is:object/is:text/is:ebook-pages/is:settings"
-        PARAGRAPHS_XPATH = "/is:object/is:text/is:ebook-pages/is:ebook-para"
-        settings = tree.xpath(SETTINGS_XPATH, namespaces=NSMAP)
-        if len(settings) > 0:
-            settings = settings[0]
-        paragraphs = tree.xpath(PARAGRAPHS_XPATH, namespaces=NSMAP)
         out_paragraphs = {}
+        markup = self.iter_native_xml(filename)
+        _, book_settings, _ = next(markup)
+        for _, (cas_id, data), _ in markup:
+            out_paragraphs[cas_id] = data
+        return (out_paragraphs, book_settings)
 
+    # Parses markup file incrementally. First record yielded is always
+    # ("settings", settings dict, pos), then ("paragraph", (cas_id, data), pos)
+    # records follow in order of appearance in file; pos is a number of bytes
+    # read so far. Processed elements are dropped, so memory usage doesn't
+    # depend on markup size
+    def iter_native_xml(self, filename):
+        settings_sent = False
+        with open(filename, "rb") as f:
+            for _, elem in etree.iterparse(f, events=("end", )):
+                if elem.tag == _tag("settings") and not settings_sent:
+                    settings_sent = True
+                    yield ("settings", self._read_settings(elem), f.tell())
+                elif elem.tag == _tag("ebook-para"):
+                    if not settings_sent:
+                        settings_sent = True
+                        yield ("settings", {}, f.tell())
+                    yield ("paragraph", self._read_paragraph(elem), f.tell())
+                elif elem.tag != _tag("ebook-page"):
+                    # children of paragraphs and settings are still needed
+                    continue
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        if not settings_sent:
+            yield ("settings", {}, 0)
+
+    def _read_settings(self, settings):
         def _process_settings(param, text):
             if param in ['start-autozones', 'margins', 'all-autozones',
                          'end-autozones', 'passthrough-zones', 'zonetypes']:
@@ -127,69 +299,108 @@ class DocumentProcessor(object):
                 return int(text)
             except ValueError:
                 return text
-        book_settings = {e.xpath('local-name()'):
-                         _process_settings(e.xpath('local-name()'), e.text)
-                         for e in settings.getchildren()} \
-            if len(settings) > 0 else {}
-        for paragraph in paragraphs:
-            cas_id = paragraph.get("id")
-            name = paragraph.get("name")
-            start_y = paragraph.get("start-y")
-            start_page = paragraph.get("start-page")
-            end_y = paragraph.get("end-y")
-            end_page = paragraph.get("end-page")
-            start = {"cas-id": cas_id,
-                     "name": name,
-                     "y": start_y,
-                     "page": start_page,
-                     "type": "start"}
-            end = {"cas-id": cas_id,
-                   "name": name,
-                   "y": end_y,
-                   "page": end_page,
-                   "type": "end"}
-            zones = []
-            for zone in paragraph.xpath("is:ebook-zone", namespaces=NSMAP):
-                objects = [{"oid": o.get("oid"),
-                            "block-id": o.get("block-id")}
-                           for o in zone.xpath("is:ebook-object",
-                                               namespaces=NSMAP)]
-                placements = [{"page": pl.get("page"),
-                               "y": pl.get("y")}
-                              for pl in zone.xpath("is:ebook-placement",
-                                                   namespaces=NSMAP)]
-                page = zone.get("page") or \
-                    next((z["page"] for z in placements), None)
-
-                def _get_zone_id():
-                    return zone.get("rubric") if zone.get("n") in ["00", None] \
-                        else zone.get("n") + zone.get("rubric")
-                new_zone = {"cas-id": cas_id,
-                            "zone-id": _get_zone_id(),
-                            "page": page,
-                            "type": zone.get("type"),
-                            "rubric": zone.get("rubric"),
-                            "placements": placements,
-                            "number": zone.get("n"),
-                            "y": zone.get("y"),
-                            "at": zone.get("at"),
-                            "objects": objects,
-                            "passthrough": zone.get("type") == u"repeat"}
-                zones.append(new_zone)
-            out_paragraphs[cas_id] = {"marks": [start, end], "zones": zones}
-        return (out_paragraphs, book_settings)
+        return {e.xpath('local-name()'):
+                _process_settings(e.xpath('local-name()'), e.text)
+                for e in settings.getchildren()}
+
+    # returns (cas_id, {"marks": [start, end], "zones": zones})
+    def _read_paragraph(self, paragraph):
+        cas_id = paragraph.get("id")
+        name = paragraph.get("name")
+        start_y = paragraph.get("start-y")
+        start_page = paragraph.get("start-page")
+        end_y = paragraph.get("end-y")
+        end_page = paragraph.get("end-page")
+        start = {"cas-id": cas_id,
+                 "name": name,
+                 "y": start_y,
+                 "page": start_page,
+                 "type": "start"}
+        end = {"cas-id": cas_id,
+               "name": name,
+               "y": end_y,
+               "page": end_page,
+               "type": "end"}
+        zones = []
+        for zone in paragraph.iterchildren(_tag("ebook-zone")):
+            objects = [{"oid": o.get("oid"),
+                        "block-id": o.get("block-id")}
+                       for o in zone.iterchildren(_tag("ebook-object"))]
+            placements = [{"page": pl.get("page"),
+                           "y": pl.get("y")}
+                          for pl in zone.iterchildren(_tag("ebook-placement"))]
+            page = zone.get("page") or \
+                next((z["page"] for z in placements), None)
+
+            def _get_zone_id():
+                return zone.get("rubric") if zone.get("n") in ["00", None] \
+                    else zone.get("n") + zone.get("rubric")
+            new_zone = {"cas-id": cas_id,
+                        "zone-id": _get_zone_id(),
+                        "page": page,
+                        "type": zone.get("type"),
+                        "rubric": zone.get("rubric"),
+                        "placements": placements,
+                        "number": zone.get("n"),
+                        "y": zone.get("y"),
+                        "at": zone.get("at"),
+                        "objects": objects,
+                        "passthrough": zone.get("type") == u"repeat"}
+            zones.append(new_zone)
+        return (cas_id, {"marks": [start, end], "zones": zones})
 
     # Paragraphs - a dict {cas-id : dict with all paragraph data}
+    # returns the whole markup as a string, save_all streams it to file instead
     def gen_native_xml(self, paragraphs, settings, progress):
-        PAGES = E("ebook-pages", src=self.filename)
+        out = BytesIO()
+        self.write_native_xml(out, paragraphs, settings, progress)
+        return out.getvalue()
+
+    # writes markup to out (a file object) element by element, so that the
+    # whole document is never kept in memory. xmlfile doesn't indent, so
+    # whitespace etree.tostring(pretty_print=True) would give is written here
+    def write_native_xml(self, out, paragraphs, settings, progress):
+        with etree.xmlfile(out, encoding="utf-8") as xf:
+            xf.write_declaration()
+            with xf.element(_tag("object"),
+                            {"display-name": settings["display-name"]},
+                            nsmap=NSMAP):
+                xf.write(_newline(1))
+                with xf.element(_tag("text")):
+                    xf.write(_newline(2))
+                    with xf.element(_tag("ebook-pages"),
+                                    {"src": self.filename}):
+                        self._write_indented(xf, self._gen_icon_set(settings))
+                        self._write_indented(xf, self._gen_settings(settings))
+                        for cas_id, data in paragraphs.items():
+                            PARA = self._gen_paragraph(cas_id, data)
+                            if PARA is not None:
+                                self._write_indented(xf, PARA)
+                        for PAGE in self._gen_pages(settings, progress):
+                            self._write_indented(xf, PAGE)
+                        xf.write(_newline(2))
+                    xf.write(_newline(1))
+                xf.write(_newline(0))
+            xf.write("\n")
+
+    # writes a child of ebook-pages on a new line, indented by its depth
+    @staticmethod
+    def _write_indented(xf, elem, level=3):
+        xf.write(_newline(level))
+        _indent(elem, level)
+        xf.write(elem, with_tail=False)
+
+    def _gen_icon_set(self, settings):
         ICON_SET = E("ebook-icon-set")
         all_zones = settings.get("zonetypes", DEFAULT_ZONE_TYPES)
         # TODO perhaps should pass precisely icons used in markup, not all?
         for icon_type in all_zones:
             icon = E("ebook-icon", rubric=icon_type, src="%s.png" % icon_type)
             ICON_SET.append(icon)
-        PAGES.append(ICON_SET)
-        # here save autozone settings
+        return ICON_SET
+
+    # here save autozone settings
+    def _gen_settings(self, settings):
         SETTINGS = E("settings")
         for key in settings:
             tag = E(key)
@@ -197,77 +408,74 @@ class DocumentProcessor(object):
                 if isinstance(settings[key], list) else settings[key]
             tag.text = unicode(value)
             SETTINGS.append(tag)
-        PAGES.append(SETTINGS)
-        # add paragraphs info
-        for cas_id, data in paragraphs.items():
-            # make sure that no paragraphs are saved without end mark
-            marks = data.get("marks", None)
-            if not marks:
-                continue
-            zones = data.get("zones", [])
-            assert len(marks) == 2, \
-                "Some paragraphs don't have end marks, can't save that way!"
-            PARA = E("ebook-para", id=str(cas_id),
-                     **{"start-page": str(marks[0]["page"]),
-                        "start-y": str(marks[0]["y"]),
-                        "name": marks[0]["name"],
-                        "end-page": str(marks[1]["page"]),
-                        "end-y": str(marks[1]["y"])})
-            for zone in zones:
-                # passthrough zones come first
-                if zone["type"] == "repeat":
-                    ZONE = E("ebook-zone", type="repeat",
-                             **{"y": str(zone["y"]),
-                                "rubric": zone["rubric"],
-                                "at": zone["at"]})
-                    for pl in zone["placements"]:
-                        ZONE.append(E("ebook-placement",
-                                    **{"page": str(pl["page"]),
-                                       "y": str(pl["y"])}))
-                else:
-                    ZONE = E("ebook-zone", type=zone["type"],
-                             **{"n": str(zone["n"]),
-                                "page": str(zone["page"]),
-                                "y": str(zone["y"]),
-                                "rubric": zone["rubric"],
-                                "at": zone["at"]})
-                for obj in zone["objects"]:
-                    ZONE.append(E("ebook-object",
-                                  **{"oid": obj["oid"],
-                                     "block-id": obj["block-id"]}))
-                PARA.append(ZONE)
-            PAGES.append(PARA)
-
-        # TODO can take a lot of time (esp. when rendering differently sized
-        # pages), show progress here
+        return SETTINGS
+
+    # returns None for paragraphs that shouldn't be saved
+    def _gen_paragraph(self, cas_id, data):
+        # make sure that no paragraphs are saved without end mark
+        marks = data.get("marks", None)
+        if not marks:
+            return None
+        zones = data.get("zones", [])
+        assert len(marks) == 2, \
+            "Some paragraphs don't have end marks, can't save that way!"
+        PARA = E("ebook-para", id=str(cas_id),
+                 **{"start-page": str(marks[0]["page"]),
+                    "start-y": str(marks[0]["y"]),
+                    "name": marks[0]["name"],
+                    "end-page": str(marks[1]["page"]),
+                    "end-y": str(marks[1]["y"])})
+        for zone in zones:
+            # passthrough zones come first
+            if zone["type"] == "repeat":
+                ZONE = E("ebook-zone", type="repeat",
+                         **{"y": str(zone["y"]),
+                            "rubric": zone["rubric"],
+                            "at": zone["at"]})
+                for pl in zone["placements"]:
+                    ZONE.append(E("ebook-placement",
+                                **{"page": str(pl["page"]),
+                                   "y": str(pl["y"])}))
+            else:
+                ZONE = E("ebook-zone", type=zone["type"],
+                         **{"n": str(zone["n"]),
+                            "page": str(zone["page"]),
+                            "y": str(zone["y"]),
+                            "rubric": zone["rubric"],
+                            "at": zone["at"]})
+            for obj in zone["objects"]:
+                ZONE.append(E("ebook-object",
+                              **{"oid": obj["oid"],
+                                 "block-id": obj["block-id"]}))
+            PARA.append(ZONE)
+        return PARA
+
+    # yields ebook-page elements, page sizes are taken from index, nothing is
+    # rendered here
+    def _gen_pages(self, settings, progress):
+        def _get_page_preview_str(page):
+            return "page-" + "0"*(3-len(str(page))) + str(page) + ".png"
+
+        def _get_fold(first_page, pagenum):
+            page_order = [first_page,
+                          next(x for x in ["l", "r"] if x != first_page)]
+            return page_order[(pagenum + 1) % 2]
+
         if progress:
             progress.setRange(1, self.totalPages)
         for page in range(1, self.totalPages):
-
-            def _get_page_preview_str(page):
-                return "page-" + "0"*(3-len(str(page))) + str(page) + ".png"
-
-            def _get_fold(first_page, pagenum):
-                page_order = [first_page,
-                              next(x for x in ["l", "r"] if x != first_page)]
-                return page_order[(pagenum + 1) % 2]
             fold = _get_fold(settings["first-page"], page)
-            PAGE = E("ebook-page",
-                     **{"preview": _get_page_preview_str(page),
-                        "n": str(page),
-                        "width": str(self.width()),
-                        "height": str(self.height()),
-                        "hide": "false",
-                        # FIXME
-                        "zone-margins": fold,
-                        "fold": fold})
-            PAGES.append(PAGE)
+            yield E("ebook-page",
+                    **{"preview": _get_page_preview_str(page),
+                       "n": str(page),
+                       "width": str(self.width(num=page - 1)),
+                       "height": str(self.height(num=page - 1)),
+                       "hide": "false",
+                       # FIXME
+                       "zone-margins": fold,
+                       "fold": fold})
             if progress:
                 progress.setValue(page)
-        root = E.object(E.text(PAGES),
-                        **{"display-name": settings["display-name"]})
-        result = etree.tostring(root, pretty_print=True, encoding="utf-8")
-        return result
 
     def gen_toc_xml(self):
         # returns last page processed
@@ -293,14 +501,28 @@ class DocumentProcessor(object):
             return
         _process_child(toc.firstChild())
 
-    # generates and saves previes, returns a list of generated filenames
-    def gen_previews(self, path):
-        filenames = []
-        for i, png in enumerate(self._render_all_to_png(), start=1):
-            name = os.path.join(path, self.png_prefix + str(i))
-            filenames.append(name)
-            png.save(name, "png")
-        return filenames
+    # generates and saves previews in a pool of processes. Only pages that
+    # have changed since previous generation (according to manifest stored
+    # next to previews) are rendered. Returns a list of preview filenames, all
+    # pages included
+    def gen_previews(self, path, progress=None):
+        generator = PreviewGenerator(self.filename, self.totalPages,
+                                     self.png_prefix, path)
+        try:
+            jobs = generator.jobs(progress)
+            if progress:
+                progress.setRange(0, len(jobs))
+            for i, (num, name) in enumerate(generator.generate(jobs),
+                                            start=1):
+                if progress:
+                    progress.setValue(i)
+                    if progress.wasCanceled():
+                        # what's done is kept and won't be rendered next time
+                        break
+        finally:
+            generator.close()
+        return [generator.preview_name(num)
+                for num in range(0, self.totalPages)]
 
     def save_error_log(self, errors, course_id, course_name):
         with open("errors.log", "a+") as f:
@@ -312,13 +534,52 @@ class DocumentProcessor(object):
                 f.write(error.message.encode('utf-8'))
                 f.write("\n")
 
+    # markup is written to a temporary file next to the target one, which is
+    # replaced only when everything has been written, so a failure halfway
+    # never leaves a truncated file
     def save_all(self, path_to_file, paragraphs, settings, progress=None):
-        with open(path_to_file, 'w') as fname:
-            fname.write(self.gen_native_xml(paragraphs, settings, progress))
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=os.path.basename(path_to_file) + ".",
+            dir=os.path.dirname(os.path.abspath(path_to_file)))
+        try:
+            with os.fdopen(fd, 'wb') as fname:
+                self.write_native_xml(fname, paragraphs, settings, progress)
+                fname.flush()
+                os.fsync(fname.fileno())
+            # mkstemp creates owner-only files, replaced file keeps its mode
+            os.chmod(tmp_name, self._file_mode(path_to_file))
+            if os.name == "nt" and os.path.exists(path_to_file):
+                # rename can't replace an existing file on windows, so it is
+                # not atomic there: old file is moved aside and put back if
+                # new one can't take its place
+                backup = tmp_name + ".old"
+                os.rename(path_to_file, backup)
+                try:
+                    os.rename(tmp_name, path_to_file)
+                except OSError:
+                    os.rename(backup, path_to_file)
+                    raise
+                os.remove(backup)
+            else:
+                os.rename(tmp_name, path_to_file)
+        except Exception:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
         return path_to_file
 
+    # mode of existing file or the one open() would create a new file with
+    @staticmethod
+    def _file_mode(path_to_file):
+        try:
+            return stat.S_IMODE(os.stat(path_to_file).st_mode)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0666 & ~umask
+
     def _is_in_pdf_bounds(self, pos_tuple, scale, viewport_delta):
-        img = self.curr_page(scale).rect()
+        img = QtCore.QRect(QtCore.QPoint(0, 0), self.page_size(scale))
         viewport = QtCore.QRect(img.x(),
                                 img.y() + viewport_delta,
                                 img.width(),
@@ -342,10 +603,3 @@ class DocumentProcessor(object):
                           unicode(t.text()))
                          for t in self.doc.page(i).textList()]
         return result
-
-    def _render_one_to_png(self, num):
-        return self.doc.page(num).renderToImage()
-
-    def _render_all_to_png(self):
-        return [self._render_one_to_png(i)
-                for i in range(0, self.doc.numPages())]
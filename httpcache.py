@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+
+
+# On-disk storage of http responses that have validators (ETag and\or
+# Last-Modified). Cached responses are revalidated with conditional requests,
+# so a document that hasn't changed costs a 304 without body. Entries are
+# keyed by url and user, as documents may depend on user's rights.
+class HttpCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # returns headers to make request for url conditional, empty list if
+    # nothing is cached
+    def conditional_headers(self, url, user):
+        meta = self._read_meta(url, user)
+        if not meta or not os.path.isfile(self._filename(url, user, "body")):
+            return []
+        headers = []
+        if meta.get("etag"):
+            headers.append("If-None-Match: %s" % meta["etag"])
+        if meta.get("last-modified"):
+            headers.append("If-Modified-Since: %s" % meta["last-modified"])
+        # curl wants byte strings, json gives unicode
+        return [h.encode("utf-8") for h in headers]
+
+    # returns cached body or None
+    def get(self, url, user):
+        try:
+            with open(self._filename(url, user, "body"), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    # stores response, headers is a dict with lowercase names. Responses
+    # without validators can't be revalidated, so they are not stored
+    def put(self, url, user, headers, body):
+        meta = {"url": url,
+                "etag": headers.get("etag"),
+                "last-modified": headers.get("last-modified")}
+        if not meta["etag"] and not meta["last-modified"]:
+            self.remove(url, user)
+            return
+        self._write(self._filename(url, user, "body"), body)
+        self._write(self._filename(url, user, "json"), json.dumps(meta))
+
+    def remove(self, url, user):
+        for ext in ["json", "body"]:
+            name = self._filename(url, user, ext)
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+
+    def _filename(self, url, user, ext):
+        if isinstance(user, unicode):
+            user = user.encode("utf-8")
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        key = hashlib.sha1(user + "\n" + url).hexdigest()
+        return os.path.join(self.directory, "%s.%s" % (key, ext))
+
+    def _read_meta(self, url, user):
+        try:
+            with open(self._filename(url, user, "json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    # files are replaced at once, so a crash never leaves a half-written one
+    def _write(self, name, data):
+        tmp_name = name + ".tmp"
+        with open(tmp_name, "wb") as f:
+            f.write(data)
+        os.rename(tmp_name, name)
@@ -8,6 +8,10 @@ from PyQt4 import QtGui, QtCore
 # cas-id
 class QImageLabel(QtGui.QLabel):
     STYLESHEET = "QImageLabel { background-color: rgb(58, 56, 56); }"
+    # ms, mouse moves are applied no more often (about once per frame)
+    MOVE_INTERVAL = 16
+    # ms, moved mark is validated when dragging pauses for that long
+    VALIDATE_DELAY = 150
     MOVE_KEYS_DELTA = {QtCore.Qt.Key_Up: QtCore.QPoint(0, -2),
                        QtCore.Qt.Key_Down: QtCore.QPoint(0, 2),
                        QtCore.Qt.Key_Left: QtCore.QPoint(-2, 0),
@@ -25,10 +29,25 @@ class QImageLabel(QtGui.QLabel):
         self.coordinates = None
         self.zoomed_signal = QtCore.SIGNAL("zoomChanged(float)")
         self.margin_color = QtGui.QColor(105, 105, 105)
+        # what pixmap shown (page image with margins) has been composed of,
+        # it is composed again only when any of that changes
+        self._frame_key = None
         super(QImageLabel, self).__init__(parent)
         self.setFocusPolicy(QtCore.Qt.StrongFocus)
         self.setStyleSheet(self.STYLESHEET)
         self.setAcceptDrops(True)
+        # mouse moves are summed up here till move timer fires
+        self._pending_delta = None
+        self._move_timer = QtCore.QTimer(self)
+        self._move_timer.setSingleShot(True)
+        self._move_timer.setInterval(self.MOVE_INTERVAL)
+        self.connect(self._move_timer, QtCore.SIGNAL("timeout()"),
+                     self._apply_move)
+        self._validate_timer = QtCore.QTimer(self)
+        self._validate_timer.setSingleShot(True)
+        self._validate_timer.setInterval(self.VALIDATE_DELAY)
+        self.connect(self._validate_timer, QtCore.SIGNAL("timeout()"),
+                     self._validate_moved)
 
     @property
     def coordinates_as_tuple(self):
@@ -68,49 +87,92 @@ class QImageLabel(QtGui.QLabel):
             self.cursor_overridden = False
             QtGui.QApplication.restoreOverrideCursor()
 
+    # returns (x offset of page, list of x of margins, total width) for page
+    # of given width
+    def _margins_layout(self, page_width):
+        if not self.controller.is_markup_mode():
+            return (0, [], page_width)
+        w = self.controller.margin_width
+        offset = w if self.controller.has_left_margin() else 0
+        margins = []
+        if self.controller.has_left_margin():
+            margins.append(0)
+        if self.controller.has_right_margin():
+            margins.append(offset + page_width)
+        return (offset, margins, page_width + w * len(margins))
+
+    # only marks intersecting rect are painted
+    def _paint_marks(self, rect):
+        painter = QtGui.QPainter(self)
+        for mark in self.controller.get_visible_marks():
+            if mark.paint_rect().intersects(rect):
+                mark.paint_me(painter)
+        painter.end()
+        self._set_cursor(self.mapFromGlobal(QtGui.QCursor.pos()))
+
+    # at high zoom whole page is never rendered: only tiles intersecting
+    # visible part of label are painted directly on it
+    def _paint_tiled(self, event):
+        size = self.controller.get_page_size()
+        if not size:
+            return
+        if self.pixmap():
+            self.clear()
+            self._frame_key = None
+        offset, margins, width = self._margins_layout(size.width())
+        self.setFixedSize(width, size.height())
+        visible = self.visibleRegion().boundingRect().intersected(
+            event.rect())
+        painter = QtGui.QPainter(self)
+        painter.setBrush(self.margin_color)
+        painter.setPen(self.margin_color)
+        for x in margins:
+            painter.drawRect(x, 0, self.controller.margin_width, size.height())
+        page_rect = visible.translated(-offset, 0)
+        for target, image, source in self.controller.get_tiles(page_rect):
+            painter.drawImage(target.translated(offset, 0), image, source)
+        painter.end()
+        self._paint_marks(event.rect())
+
     # override paint event
     def paintEvent(self, event):
-        super(QImageLabel, self).paintEvent(event)
+        if self.controller.is_tiled():
+            self._paint_tiled(event)
+            self.bookviewer.update_chrome()
+            return
         img = self.controller.get_image()
-        pixmap = None
         if img:
-            if self.controller.is_markup_mode():
-                # get margins info in order to add rects to image
-                w = self.controller.margin_width
-                m_width = w
-                if self.controller.has_both_margins():
-                    m_width = m_width + w
-                resulting_pmp = QtGui.QPixmap(m_width + img.width(), img.height())
-                pixmap_painter = QtGui.QPainter(resulting_pmp)
-                pixmap_painter.setBrush(self.margin_color)
-                pixmap_painter.setPen(self.margin_color)
-                img_pmp = QtGui.QPixmap.fromImage(img)
-                if self.controller.has_left_margin():
-                    pixmap_painter.drawRect(0, 0, w, img.height())
-                    pixmap_painter.drawPixmap(w, 0, img.width(), img.height(),
-                                              img_pmp)
-                else:
-                    pixmap_painter.drawPixmap(0, 0, img.width(), img.height(),
-                                              img_pmp)
-                if self.controller.has_both_margins():
-                    pixmap_painter.drawRect(w + img.width(), 0, w, img.height())
-                elif self.controller.has_right_margin():
-                    pixmap_painter.drawRect(img.width(), 0, w, img.height())
-                pixmap_painter.end()
-                pixmap = resulting_pmp
-            else:
-                pixmap = QtGui.QPixmap.fromImage(img)
-            # update all necessary data in parent (bookviewer)
-            self.setPixmap(pixmap)
-            self.setFixedSize(pixmap.size())
-            painter = QtGui.QPainter(self)
-            marks_and_rulers = self.controller.get_current_page_marks() + \
-                            self.controller.get_rulers()
-            for mark in marks_and_rulers:
-                mark.paint_me(painter)
-                mark.update()
-            self._set_cursor(self.mapFromGlobal(QtGui.QCursor.pos()))
-        self.bookviewer.update()
+            self._update_frame(img)
+        super(QImageLabel, self).paintEvent(event)
+        if img:
+            self._paint_marks(event.rect())
+        self.bookviewer.update_chrome()
+
+    # composes page image with margins into label's pixmap, unless the one
+    # shown has been composed of the same image (cacheKey changes when a
+    # preview is replaced by exact render) and margins
+    def _update_frame(self, img):
+        offset, margins, width = self._margins_layout(img.width())
+        key = (self.controller.pagenum, self.controller.scale,
+               self.controller.operational_mode, img.cacheKey(),
+               tuple(margins), width)
+        if key == self._frame_key:
+            return
+        if margins:
+            pixmap = QtGui.QPixmap(width, img.height())
+            pixmap_painter = QtGui.QPainter(pixmap)
+            pixmap_painter.setBrush(self.margin_color)
+            pixmap_painter.setPen(self.margin_color)
+            for x in margins:
+                pixmap_painter.drawRect(x, 0, self.controller.margin_width,
+                                        img.height())
+            pixmap_painter.drawImage(offset, 0, img)
+            pixmap_painter.end()
+        else:
+            pixmap = QtGui.QPixmap.fromImage(img)
+        self.setPixmap(pixmap)
+        self.setFixedSize(pixmap.size())
+        self._frame_key = key
 
     def mousePressEvent(self, event):
         # general for both modes
@@ -153,17 +215,44 @@ class QImageLabel(QtGui.QLabel):
                     self.controller.deselect_all()
                     mark = self.controller._create_mark_on_click(
                         self.coordinates_as_tuple, self)
-                    mark.bind_to_ruler(selected)
+                    self.controller.bind_to_ruler(mark, selected)
                 else:
                     process_selected(selected)
         self.update()
 
+    # moves are coalesced: deltas are summed up and applied by _apply_move
+    # at most once per MOVE_INTERVAL
     def mouseMoveEvent(self, event):
         delta = QtCore.QPoint(event.pos().x() - self.coordinates.x(),
                               event.pos().y() - self.coordinates.y())
         self.coordinates = event.pos()
-        self.controller.move((delta.x(), delta.y()), self.coordinates_as_tuple)
-        self.update()
+        self._pending_delta = delta if self._pending_delta is None \
+            else self._pending_delta + delta
+        if not self._move_timer.isActive():
+            self._move_timer.start()
+
+    # moved marks schedule repaint of their old and new places themselves,
+    # validation is postponed till dragging pauses or ends
+    def _apply_move(self):
+        if self._pending_delta is None:
+            return
+        delta = self._pending_delta
+        self._pending_delta = None
+        self.controller.move((delta.x(), delta.y()), self.coordinates_as_tuple,
+                             validate=False)
+        self._validate_timer.start()
+
+    # validation changes toc states, console and actions have to be
+    # refreshed even if nothing is repainted after it
+    def _validate_moved(self):
+        self.controller.validate_moved()
+        self.bookviewer.update_chrome()
+
+    def mouseReleaseEvent(self, event):
+        self._move_timer.stop()
+        self._apply_move()
+        self._validate_timer.stop()
+        self._validate_moved()
 
     def keyPressEvent(self, event):
         if self.controller.selected_marks_and_rulers != [] and \
@@ -171,4 +260,5 @@ class QImageLabel(QtGui.QLabel):
             delta = self.MOVE_KEYS_DELTA[event.key()]
             self.coordinates = self.coordinates + delta
             self.controller.move(delta, self.coordinates_as_tuple)
+            return
         self.update()
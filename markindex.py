@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from bisect import bisect_left, bisect_right
+
+
+# Finds marks at point without testing every mark on page. Marks are kept
+# sorted by top y, so only those starting no higher than the tallest mark
+# above the point are tested. Results are the same as a linear search over
+# marks in the order given: the first matching mark wins.
+# Marks' geometry is read when they are added or updated, so update() has to
+# be called every time a mark changes geometry.
+class MarkIndex(object):
+    def __init__(self, marks):
+        # mark -> (top y, order in marks)
+        self._key_of = {}
+        self._keys = []
+        self._marks = []
+        self._max_height = 0
+        for i, mark in enumerate(marks):
+            self._insert(mark, i)
+
+    def __len__(self):
+        return len(self._marks)
+
+    def __contains__(self, mark):
+        return mark in self._key_of
+
+    def update(self, mark):
+        key = self._key_of.get(mark)
+        if key is None:
+            return
+        self._remove(key)
+        self._insert(mark, key[1])
+
+    # first mark containing point
+    def find_at_point(self, point_tuple):
+        x, y = point_tuple
+        return self._find(y, y, lambda m: m.contains(point_tuple))
+
+    # first mark intersecting rect (x1, y1, x2, y2)
+    def find_in_rect(self, rect_tuple):
+        x1, y1, x2, y2 = rect_tuple
+        return self._find(y1, y2, lambda m: m.intersects(rect_tuple))
+
+    def _find(self, y1, y2, matches):
+        lo = bisect_left(self._keys, (y1 - self._max_height, ))
+        hi = bisect_right(self._keys, (y2, len(self._marks)))
+        found = None
+        for i in xrange(lo, hi):
+            if (found is None or self._keys[i][1] < found[0]) and \
+                    matches(self._marks[i]):
+                found = (self._keys[i][1], self._marks[i])
+        return found[1] if found else None
+
+    def _insert(self, mark, order):
+        x, y, w, h = mark.geometry_as_tuple()
+        key = (y, order)
+        i = bisect_left(self._keys, key)
+        self._keys.insert(i, key)
+        self._marks.insert(i, mark)
+        self._key_of[mark] = key
+        self._max_height = max(self._max_height, h)
+
+    def _remove(self, key):
+        i = bisect_left(self._keys, key)
+        del self._keys[i]
+        del self._marks[i]
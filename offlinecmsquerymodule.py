@@ -1,3 +1,4 @@
+import os
 import json
 from cmsquerymodule import CmsQueryModule
 
@@ -5,8 +6,10 @@ from cmsquerymodule import CmsQueryModule
 class OfflineCmsQueryModule(CmsQueryModule):
     DEFAULT_CONFIG = "offline-data/offline_config"
     OFFLINE_COURSE = "offline-data/offline_course"
+    OFFLINE_SNAPSHOT = "offline-data/offline_course.sqlite"
+    _offline_snapshot = None
 
-    def _fetch_data(self, filename, login=None, password=None):
+    def _fetch_data(self, filename, login=None, password=None, cached=False):
         data = None
         try:
             with open(filename) as f:
@@ -20,8 +23,29 @@ class OfflineCmsQueryModule(CmsQueryModule):
     def search_for_course(self, name_part, login=None, password=None):
         return [("Just a demo course", self.OFFLINE_COURSE)]
 
+    def get_zone_types(self, login, password, course_id=None):
+        if self._offline_snapshot and self._offline_snapshot["zone-types"]:
+            return self._offline_snapshot["zone-types"]
+        return super(OfflineCmsQueryModule, self).get_zone_types(
+            login, password, course_id)
+
     def get_cms_course_toc(self, login, password, course_id=None,
-                           progress=None):
+                           progress=None, on_names=None, on_lesson=None):
+        # snapshot is preferred, it loads much faster. Demo course is served
+        # whatever course id is and is never refreshed, so snapshot is kept
+        # aside and never expires
+        if not self._offline_snapshot and \
+                os.path.isfile(self.OFFLINE_SNAPSHOT):
+            self._offline_snapshot = self._snapshots.pop(
+                self.load_snapshot(self.OFFLINE_SNAPSHOT))
+        if self._offline_snapshot:
+            self.display_name = self._offline_snapshot["display-name"]
+            self._notify_loaded(self._offline_snapshot["toc"], on_names,
+                                on_lesson)
+            return (self._offline_snapshot["toc"],
+                    self._offline_snapshot["autozone-types"])
         toc = [json.loads(t) for t in self._fetch_data(self.OFFLINE_COURSE)[1]]
         autotypes = self._get_autozone_types(toc)
+        self._last_course = (course_id or self.OFFLINE_COURSE, toc, autotypes)
+        self._notify_loaded(toc, on_names, on_lesson)
         return (toc, autotypes)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+
+
+# Memory-bounded LRU storage for rendered page images. Keys are tuples
+# (page, scale) for whole pages and (page, scale, col, row) for tiles, values
+# are QImages; every entry is charged its size in bytes
+# and least recently used entries are evicted once the budget is exceeded, so
+# resident memory stays flat no matter how many pages have been visited.
+# Cache can be filled from prefetching threads, so all access is locked.
+class PageCache(object):
+    # 256 Mb is enough for a dozen of pages at max zoom
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, max_bytes=None, cost_func=None):
+        self.max_bytes = max_bytes or self.DEFAULT_MAX_BYTES
+        # returns size of a cached value in bytes
+        self.cost_func = cost_func or (lambda image: image.byteCount())
+        # key -> (value, cost), most recently used entries come last
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        # counters, useful for profiling
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    @property
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max-bytes": self.max_bytes}
+
+    # returns cached value or None, marks entry as recently used
+    def get(self, key):
+        with self._lock:
+            try:
+                value, cost = self._entries.pop(key)
+            except KeyError:
+                self.misses = self.misses + 1
+                return None
+            self._entries[key] = (value, cost)
+            self.hits = self.hits + 1
+            return value
+
+    def put(self, key, value):
+        cost = self.cost_func(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            # an entry bigger than the whole budget is never kept
+            if cost > self.max_bytes:
+                return value
+            self._entries[key] = (value, cost)
+            self.total_bytes = self.total_bytes + cost
+            self._evict()
+            return value
+
+    # returns cached value or renders it with given func and stores the result
+    def get_or_render(self, key, render_func):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, render_func())
+        return value
+
+    # returns scales page has been rendered in as a whole (not by tiles)
+    def scales(self, page):
+        with self._lock:
+            return [k[1] for k in self._entries
+                    if k[0] == page and len(k) == 2]
+
+    # drop all entries (for example when another document is opened)
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    # drop all entries of a given page, in all scales, tiles included
+    def invalidate_page(self, page):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == page]:
+                self._remove(key)
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _remove(self, key):
+        value, cost = self._entries.pop(key)
+        self.total_bytes = self.total_bytes - cost
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, (value, cost) = self._entries.popitem(last=False)
+            self.total_bytes = self.total_bytes - cost
+            self.evictions = self.evictions + 1
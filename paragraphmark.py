@@ -3,29 +3,38 @@
 from PyQt4 import QtGui, QtCore
 
 
-class QMark(QtGui.QWidget):
+# Mark is a piece of data (geometry, name, selection and visibility state)
+# without widgets of its own: visible marks of a page are drawn by their
+# parent (QImageLabel) in one pass, see paint_me. Showing or hiding a mark only
+# flips a flag and schedules parent's repaint.
+# Mark's geometry is kept in pdf coordinates as well, screen geometry is
+# projected from them only when mark's scale is changed (see set_scale), so
+# zooming in and out doesn't accumulate rounding errors.
+class QMark(object):
     WIDTH = 5
     SELECT_COLOUR = QtGui.QColor(0, 0, 0, 32)
     DESELECT_COLOUR = QtGui.QColor(180, 180, 180, 32)
+    # which of (x, y, width, height) change with zoom, others are in pixels
+    SCALED = (True, True, True, False)
 
     # pos in a tuple (x, y)
     def __init__(self, pos, parent, name, delete_func, corrections):
-        super(QMark, self).__init__(parent)
+        super(QMark, self).__init__()
         self.parent = parent
         self.corrections = corrections
         self.corrected = False
         self.is_selected = False
         self.cursor = QtGui.QCursor(QtCore.Qt.SizeAllCursor)
         self.delete_func = delete_func
-        self.mark = QtGui.QRubberBand(QtGui.QRubberBand.Rectangle, parent)
+        # called with mark every time it changes geometry
+        self.on_geometry_changed = None
+        self.is_visible = False
+        # scale geometry on screen is in
+        self._scale = 1.0
         (pos_x, pos_y) = pos
-        self.mark.setGeometry(QtCore.QRect(QtCore.QPoint(pos_x, pos_y),
-                                           QtCore.QSize(parent.width(),
-                                                        self.WIDTH)))
+        self._set_rect(QtCore.QRect(QtCore.QPoint(pos_x, pos_y),
+                                    QtCore.QSize(parent.width(), self.WIDTH)))
         self.name = name
-        self.label = QtGui.QLabel(self.name, parent)
-        self._adjust_to_mark()
-        self.update()
 
     def is_paragraph(self):
         return isinstance(self, QParagraphMark)
@@ -69,11 +78,31 @@ class QMark(QtGui.QWidget):
     def pos_as_tuple(self):
         return (self.pos().x(), self.pos().y())
 
+    def label_text(self):
+        return self.name
+
+    # part of parent mark is painted in
+    def paint_rect(self):
+        label_rect = self.label_rect()
+        rect = self._rect.united(label_rect) if label_rect else self._rect
+        # antialiasing might touch neighbour pixels
+        return rect.adjusted(-1, -1, 1, 1)
+
+    # rect the name is painted in, None if mark has no label
+    def label_rect(self):
+        text = self.label_text()
+        if not text:
+            return None
+        metrics = QtGui.QFontMetrics(self.parent.font())
+        return QtCore.QRect(self._rect.x(), self._rect.y(),
+                            metrics.width(text), metrics.height())
+
     def hide(self):
         # hide marks, and restore all corrections -> marks are stored as they
         # are, in pdf-coordinates
-        self.mark.hide()
-        self.label.hide()
+        if self.is_visible:
+            self.update()
+            self.is_visible = False
         (l, r) = self.corrections
         if self.corrected:
             self._apply_corrections((-l, -r))
@@ -83,24 +112,54 @@ class QMark(QtGui.QWidget):
         if not self.corrected:
             self._apply_corrections(self.corrections)
             self.corrected = True
-        self.mark.show()
-        self.label.show()
+        self.is_visible = True
+        self.update()
 
     def geometry(self):
-        return self.mark.geometry()
+        return QtCore.QRect(self._rect)
 
     def set_geometry(self, rect):
-        self.mark.setGeometry(rect)
-        self._adjust_to_mark()
+        self._set_rect(rect)
+        self.update()
+
+    def _set_rect(self, rect):
+        self._pdf_rect = self._to_pdf(rect)
+        self._update_rect(rect)
+
+    # both old and new places of a visible mark are repainted
+    def _update_rect(self, rect):
+        self.update()
+        self._rect = QtCore.QRect(rect)
         self.update()
+        if self.on_geometry_changed:
+            self.on_geometry_changed(self)
 
     def paint_me(self, painter):
-        if self.is_selected:
-            painter.fillRect(self.mark.geometry(), self.SELECT_COLOUR)
-            painter.fillRect(self.label.geometry(), self.SELECT_COLOUR)
-        else:
-            painter.fillRect(self.mark.geometry(), self.DESELECT_COLOUR)
-            painter.fillRect(self.label.geometry(), self.DESELECT_COLOUR)
+        if not self.is_visible:
+            return
+        painter.save()
+        self._paint_mark(painter)
+        colour = self.SELECT_COLOUR if self.is_selected \
+            else self.DESELECT_COLOUR
+        painter.fillRect(self._rect, colour)
+        label_rect = self.label_rect()
+        if label_rect:
+            painter.fillRect(label_rect, colour)
+            painter.setPen(self.parent.palette().color(
+                QtGui.QPalette.WindowText))
+            painter.drawText(label_rect,
+                             QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                             self.label_text())
+        painter.restore()
+
+    # looks like a QRubberBand
+    def _paint_mark(self, painter):
+        colour = QtGui.QColor(self.parent.palette().color(
+            QtGui.QPalette.Highlight))
+        painter.setPen(colour)
+        colour.setAlpha(64)
+        painter.setBrush(colour)
+        painter.drawRect(self._rect.adjusted(0, 0, -1, -1))
 
     def toggle_selected(self):
         self.is_selected = not self.is_selected
@@ -112,52 +171,61 @@ class QMark(QtGui.QWidget):
 
     def destroy(self):
         self.hide()
-        self.mark.setParent(None)
-        self.label.setParent(None)
-        self.mark.deleteLater()
-        self.label.deleteLater()
-
-    def _adjust_to_mark(self):
-        self.label.setGeometry(self.mark.x(),
-                               self.mark.y(),
-                               self.label.width(),
-                               self.label.height())
-        self.label.adjustSize()
-
-
-    def adjust(self, scale):
-        rect = self.geometry()
-        self.mark.setGeometry(rect.x() * scale,
-                              rect.y() * scale,
-                              rect.width() * scale,
-                              rect.height())
-        self._adjust_to_mark()
+
+    # screen geometry is projected to scale from pdf coordinates
+    def set_scale(self, scale):
+        if scale == self._scale:
+            return
+        self._scale = scale
+        self._update_rect(self._from_pdf(self._pdf_rect))
+
+    # tells that geometry mark has been created with is in given scale
+    def set_origin_scale(self, scale):
+        self._scale = scale
+        self._pdf_rect = self._to_pdf(self._rect)
+
+    def _to_pdf(self, rect):
+        return tuple(float(v) / self._scale if scaled else v
+                     for v, scaled in zip((rect.x(), rect.y(), rect.width(),
+                                           rect.height()), self.SCALED))
+
+    def _from_pdf(self, pdf_rect):
+        return QtCore.QRect(*[int(round(v * self._scale)) if scaled else v
+                              for v, scaled in zip(pdf_rect, self.SCALED)])
 
     def select(self, value):
         self.is_selected = value
 
     def y(self):
-        return self.geometry().y()
+        return self._rect.y()
+
+    def pdf_x(self):
+        return self._pdf_rect[0]
+
+    def pdf_y(self):
+        return self._pdf_rect[1]
 
     def x(self):
-        return self.geometry().x()
+        return self._rect.x()
 
     def pos(self):
-        return self.mark.pos()
+        return self._rect.topLeft()
 
+    # schedules repaint of the part of parent mark is painted in, nothing to
+    # do while mark is not visible
     def update(self):
-        self.mark.update()
-        self.label.update()
+        if self.is_visible:
+            self.parent.update(self.paint_rect())
 
     def contains(self, point_tuple):
         x, y = point_tuple
         point = QtCore.QPoint(x, y)
-        return self.geometry().contains(point)
+        return self._rect.contains(point)
 
     def intersects(self, rect_tuple):
         x1, y1, x2, y2 = rect_tuple
         rect = QtCore.QRect(QtCore.QPoint(x1, y1), QtCore.QPoint(x2, y2))
-        return self.geometry().intersects(rect)
+        return self._rect.intersects(rect)
 
     def _calc_move(self, (delta_x, delta_y)):
         x, y, w, h = self.geometry_as_tuple()
@@ -166,8 +234,7 @@ class QMark(QtGui.QWidget):
     # here delta is a tuple (x, y)
     def move(self, delta):
         x, y, w, h = self._calc_move(delta)
-        self.mark.setGeometry(x, y, w, h)
-        self._adjust_to_mark()
+        self._set_rect(QtCore.QRect(x, y, w, h))
 
     def delete(self):
         self.delete_func(self)
@@ -187,9 +254,9 @@ class QParagraphMark(QMark):
         self.page = page
         self.ruler = None
         self.type = type
-        self.label.setText(u"%s    %s" % (self.LABELS.get(self.type, u""),
-                                          self.name))
-        self._adjust_to_mark()
+
+    def label_text(self):
+        return u"%s    %s" % (self.LABELS.get(self.type, u""), self.name)
 
     def bind_to_ruler(self, ruler):
         self.ruler = ruler
@@ -210,29 +277,15 @@ class QRulerMark(QMark):
                  corrections):
         super(QRulerMark, self).__init__(pos, parent, name, delete_func,
                                          corrections)
-        # label is not needed, so have to overload all methods using it,
-        # escpecialling those which do repainting
-        self.label.hide()
         self.show()
 
-    def show(self):
-        super(QRulerMark, self).show()
-        self.mark.show()
-        self.label.hide()
+    # rulers have no labels
+    def label_text(self):
+        return None
 
     def set_mark_geometry(self, mark):
         mark.set_geometry(self.geometry())
 
-    def update(self):
-        self.mark.update()
-        self.label.hide()
-
-    def paint_me(self, painter):
-        if self.is_selected:
-            painter.fillRect(self.mark.geometry(), self.SELECT_COLOUR)
-        else:
-            painter.fillRect(self.mark.geometry(), self.DESELECT_COLOUR)
-
 
 class QHorizontalRuler(QRulerMark):
     def __init__(self, pos, parent, delete_func, corrections, name=""):
@@ -242,6 +295,8 @@ class QHorizontalRuler(QRulerMark):
 
 
 class QVerticalRuler(QRulerMark):
+    SCALED = (True, True, False, True)
+
     def __init__(self, pos, parent, delete_func, corrections, name=""):
         (pos_x, pos_y) = pos
         super(QRulerMark, self).__init__((pos_x, 0), parent, name,
@@ -255,14 +310,6 @@ class QVerticalRuler(QRulerMark):
         x, y, w, h = self.geometry_as_tuple()
         return (x + delta_x, y, w, h)
 
-    def adjust(self, scale):
-        rect = self.geometry()
-        self.mark.setGeometry(rect.x() * scale,
-                              rect.y() * scale,
-                              rect.width(),
-                              rect.height() * scale)
-        self._adjust_to_mark()
-
     def set_mark_geometry(self, mark):
         g = self.geometry()
         m = mark.geometry()
@@ -270,8 +317,10 @@ class QVerticalRuler(QRulerMark):
 
 
 class QStartParagraph(QParagraphMark):
+    # hidden marks are not painted until page they are
+    # at is shown
     def __init__(self, pos, parent, cas_id, name, page, delete_func,
-                 corrections=(0, 0)):
+                 corrections=(0, 0), hidden=False):
         super(QStartParagraph, self).__init__(pos,
                                               parent,
                                               cas_id,
@@ -280,11 +329,14 @@ class QStartParagraph(QParagraphMark):
                                               delete_func,
                                               "start",
                                               corrections)
-        self.show()
+        if not hidden:
+            self.show()
 
 class QEndParagraph(QParagraphMark):
+    # hidden marks are not painted until page they are
+    # at is shown
     def __init__(self, pos, parent, cas_id, name, page, delete_func,
-                 corrections=(0, 0)):
+                 corrections=(0, 0), hidden=False):
         super(QEndParagraph, self).__init__(pos,
                                             parent,
                                             cas_id,
@@ -293,7 +345,8 @@ class QEndParagraph(QParagraphMark):
                                             delete_func,
                                             "end",
                                             corrections)
-        self.show()
+        if not hidden:
+            self.show()
 
 
 MARKS_DICT = {"start": QStartParagraph,
@@ -302,9 +355,9 @@ MARKS_DICT = {"start": QStartParagraph,
               QRulerMark.ORIENT_VERTICAL: QVerticalRuler}
 
 def make_paragraph_mark(pos, parent, cas_id, name, page, delete_func, type,
-                        corrections=(0, 0)):
+                        corrections=(0, 0), hidden=False):
     return MARKS_DICT[type](pos, parent, cas_id, name, page, delete_func,
-                            corrections)
+                            corrections, hidden)
 
 def make_ruler_mark(pos, parent, delete_func, type,
                     corrections=(0, 0), name=u""):
@@ -342,6 +395,9 @@ class MarkCreator(object):
 
 # here type means zone type stored in xml (single, repeat etc)
 class QZoneMark(QParagraphMark):
+    # zone is an icon of fixed size
+    SCALED = (True, True, False, False)
+
     def __init__(self, pos, parent, cas_id, zone_id, page,
                  delete_func, objects, rubric, margin, number, icon,
                  corrections=(0, 0), auto=False, pass_through=False):
@@ -352,23 +408,24 @@ class QZoneMark(QParagraphMark):
         self.pass_through = pass_through
         self.margin = margin
         self.rubric = rubric
-        # pages that zone should appear at
+        # pages that zone should appear at, y in pdf coordinates
         (pos_x, pos_y) = pos
         self.pages = {page: pos_y}
         # just a list of dicts [ {oid, block-id, rubric} ]
         self.objects = objects
         self.number = number
         self.zone_id = zone_id
-        # destroy unnecessary rubberband
-        mark_pos = self.mark.pos()
-        self.mark.hide()
-        self.mark.setParent(None)
-        self.mark = QtGui.QLabel(zone_id, parent)
-        self.mark.setPixmap(QtGui.QPixmap.fromImage(icon))
-        geometry = QtCore.QRect(mark_pos.x(), mark_pos.y(), icon.width(),
-                                icon.height())
-        self.mark.setGeometry(geometry)
-        self.mark.show()
+        # zone is shown as an icon instead of a rubberband
+        self.icon = icon
+        self._set_rect(QtCore.QRect(self._rect.x(), self._rect.y(),
+                                    icon.width(), icon.height()))
+
+    # zone is painted as its icon without label
+    def label_text(self):
+        return None
+
+    def _paint_mark(self, painter):
+        painter.drawImage(self._rect.topLeft(), self.icon)
 
     def change_corrections(self, new_corrections, page):
         # to make not corrected if corrected
@@ -377,28 +434,17 @@ class QZoneMark(QParagraphMark):
         if self.should_show(page):
             self.show()
 
-    def adjust(self, scale):
-        rect = self.geometry()
-        self.mark.setGeometry(rect.x() * scale,
-                              rect.y() * scale,
-                              rect.width(),
-                              rect.height())
-        self._adjust_to_mark()
+    def set_origin_scale(self, scale):
+        super(QZoneMark, self).set_origin_scale(scale)
+        self.pages = dict((p, self._page_pos_to_pdf(pos, scale))
+                          for (p, pos) in self.pages.items())
 
-    def show(self):
-        super(QZoneMark, self).show()
-        self.mark.show()
-        self.label.hide()
+    def _page_pos_to_pdf(self, pos_y, scale):
+        return float(pos_y) / scale
 
     def should_show(self, page):
         return page == self.page
 
-    def paint_me(self, painter):
-        if self.is_selected:
-            painter.fillRect(self.mark.geometry(), self.SELECT_COLOUR)
-        else:
-            painter.fillRect(self.mark.geometry(), self.DESELECT_COLOUR)
-
     def set_page(self, page):
         pass
 
@@ -406,7 +452,7 @@ class QZoneMark(QParagraphMark):
         return {"n": self.number,
                 "type": self.type,
                 "page": self.page,
-                "y": self.y(),
+                "y": self.pdf_y(),
                 "rubric": self.rubric,
                 "objects": self.objects,
                 "at": self.margin }
@@ -458,20 +504,20 @@ class QPassThroughZoneMark(QZoneMark):
             return
         g = self.geometry()
         self.set_geometry(QtCore.QRect(g.x(),
-                                       self.pages[self.page], g.width(),
-                                       g.height()))
+                                       int(round(self.pages[self.page] *
+                                                 self._scale)),
+                                       g.width(), g.height()))
 
     def move(self, delta):
         super(QPassThroughZoneMark, self).move(delta)
-        g = self.geometry()
-        self.pages[self.page] = g.y()
+        self.pages[self.page] = self.pdf_y()
 
     def to_dict(self):
         return {"n": self.number,
                 "type": self.type,
                 "placements": [{'page':p, 'y':y} for (p, y)
                                in self.pages.items()],
-                "y": self.y(),
+                "y": self.pdf_y(),
                 "rubric": self.rubric,
                 "objects": self.objects,
                 "at": self.margin }
@@ -501,8 +547,9 @@ class QInnerZoneMark(QZoneMark):
         if not self.should_show(self.page):
             return
         g = self.geometry()
-        self.set_geometry(QtCore.QRect(self.pages[self.page][0],
-                                       self.pages[self.page][1],
+        (x, y) = self.pages[self.page]
+        self.set_geometry(QtCore.QRect(int(round(x * self._scale)),
+                                       int(round(y * self._scale)),
                                        g.width(), g.height()))
     def _calc_move(self, (delta_x, delta_y)):
         x, y, w, h = self.geometry_as_tuple()
@@ -510,16 +557,18 @@ class QInnerZoneMark(QZoneMark):
 
     def move(self, delta):
         super(QInnerZoneMark, self).move(delta)
-        g = self.geometry()
-        self.pages[self.page] = (g.x(), g.y())
+        self.pages[self.page] = (self.pdf_x(), self.pdf_y())
+
+    def _page_pos_to_pdf(self, (x, y), scale):
+        return (float(x) / scale, float(y) / scale)
 
     def to_dict(self):
         return {"n": self.number,
                 "type": self.type,
                 "placements": [{'page':p, 'y':y} for (p, y)
                                in self.pages.items()],
-                "x": self.x(),
-                "y": self.y(),
+                "x": self.pdf_x(),
+                "y": self.pdf_y(),
                 "rubric": self.rubric,
                 "objects": self.objects,
                 "at": self.margin }
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import traceback
+from itertools import count
+from Queue import PriorityQueue, Empty
+from PyQt4 import QtCore
+from popplerqt4 import Poppler
+
+RESOLUTION = 72.0
+RENDER_HINT = Poppler.Document.TextAntialiasing
+# side of a square tile in pixels (tiles are used at high zoom)
+TILE_SIZE = 512
+
+
+def load_document(filename):
+    doc = Poppler.Document.load(filename)
+    doc.setRenderHint(RENDER_HINT)
+    return doc
+
+
+# returns a QImage of page num (0 for first page) rendered in given scale
+def render_page(doc, num, scale):
+    page = doc.page(num)
+    return page.renderToImage(RESOLUTION * scale,
+                              RESOLUTION * scale,
+                              0,
+                              0,
+                              page.pageSize().width() * scale,
+                              page.pageSize().height() * scale,
+                              0)
+
+
+# returns (x, y, w, h) of tile (col, row) of a page of size (width, height),
+# tiles on the right and bottom edges are cut to fit the page
+def tile_rect(width, height, col, row):
+    x = col * TILE_SIZE
+    y = row * TILE_SIZE
+    return (x, y, min(TILE_SIZE, width - x), min(TILE_SIZE, height - y))
+
+
+# returns a QImage with tile (col, row) of page num rendered in given scale
+def render_tile(doc, num, scale, col, row):
+    page = doc.page(num)
+    x, y, w, h = tile_rect(int(page.pageSize().width() * scale),
+                           int(page.pageSize().height() * scale), col, row)
+    return page.renderToImage(RESOLUTION * scale,
+                              RESOLUTION * scale,
+                              x, y, w, h, 0)
+
+
+# renders whatever page cache key stands for: (num, scale) is a whole page,
+# (num, scale, col, row) is a tile
+def render_key(doc, key):
+    if len(key) == 2:
+        return render_page(doc, *key)
+    return render_tile(doc, *key)
+
+
+# Lives in GUI thread and re-emits notifications about pages rendered in
+# background, so that views can be connected to it as to any other widget
+class RenderNotifier(QtCore.QObject):
+    def __init__(self):
+        super(RenderNotifier, self).__init__()
+        self.rendered_signal = QtCore.SIGNAL("pageRendered(int, float)")
+
+    # called from worker threads, delivered through the event loop
+    def notify(self, num, scale):
+        self.emit(self.rendered_signal, num, scale)
+
+
+# Renders pages around the current one in background threads and puts them
+# into page cache, so that turning a page is a cache hit. Poppler documents
+# are not thread-safe, so every worker loads a document of its own.
+# Every schedule() call cancels jobs left from previous ones (user has jumped
+# to another page or changed zoom). Jobs are identified by page cache keys,
+# so tiles can be rendered here as well.
+class PagePrefetcher(object):
+    DEFAULT_WORKERS = 2
+    # how many pages before and after the current one to render
+    DEFAULT_DEPTH = 2
+    # job priorities, the lower the sooner
+    PRIORITY_STOP = 0
+    PRIORITY_URGENT = 1
+    PRIORITY_PREFETCH = 2
+
+    def __init__(self, filename, page_cache, workers=None, depth=None,
+                 on_rendered=None):
+        self.filename = filename
+        self.page_cache = page_cache
+        self.depth = depth or self.DEFAULT_DEPTH
+        # called from worker thread as on_rendered(num, scale)
+        self.on_rendered = on_rendered
+        self._jobs = PriorityQueue()
+        # keeps jobs of equal priority in order of scheduling
+        self._order = count()
+        # keys of jobs waiting in queue
+        self._pending = set()
+        # jobs of older generations still waiting in queue are skipped
+        self._generation = 0
+        self._local = threading.local()
+        self._threads = []
+        for i in range(workers or self.DEFAULT_WORKERS):
+            thread = threading.Thread(target=self._work,
+                                      name="prefetch-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    # schedule rendering of pages num+-1..num+-depth in given scale
+    def schedule(self, num, scale, total_pages):
+        self.cancel()
+        for delta in range(1, self.depth + 1):
+            # next pages are more likely to be needed than previous ones
+            for page in [num + delta, num - delta]:
+                if 0 <= page < total_pages:
+                    self._put(self.PRIORITY_PREFETCH, (page, scale))
+
+    # render page as soon as any worker is free (page is needed right now)
+    def request(self, num, scale):
+        self._put(self.PRIORITY_URGENT, (num, scale))
+
+    # render a tile, urgent ones are those visible right now
+    def request_tile(self, num, scale, col, row, urgent=False):
+        self._put(self.PRIORITY_URGENT if urgent else self.PRIORITY_PREFETCH,
+                  (num, scale, col, row))
+
+    # drops all pending jobs, returns new generation number
+    def cancel(self):
+        self._generation = self._generation + 1
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except Empty:
+            pass
+        self._pending.clear()
+        return self._generation
+
+    def shutdown(self):
+        self.cancel()
+        for thread in self._threads:
+            self._jobs.put((self.PRIORITY_STOP, next(self._order), None,
+                            None))
+        self._threads = []
+
+    def _put(self, priority, key):
+        if key in self._pending or key in self.page_cache:
+            return
+        self._pending.add(key)
+        self._jobs.put((priority, next(self._order), self._generation, key))
+
+    def _document(self):
+        doc = getattr(self._local, "doc", None)
+        if doc is None:
+            doc = self._local.doc = load_document(self.filename)
+        return doc
+
+    def _work(self):
+        while True:
+            priority, order, generation, key = self._jobs.get()
+            if priority == self.PRIORITY_STOP:
+                return
+            if generation != self._generation:
+                continue
+            try:
+                self._render(key)
+            except Exception:
+                # broken page (poppler error etc) must not stop the worker
+                print "could not render %s in background" % (key, )
+                traceback.print_exc()
+            finally:
+                self._pending.discard(key)
+
+    # render finished is kept even if its job has been canceled meanwhile:
+    # cache key stays valid, and a neighbour page is likely to be shown next
+    def _render(self, key):
+        if key in self.page_cache:
+            return
+        image = render_key(self._document(), key)
+        self.page_cache.put(key, image)
+        if self.on_rendered:
+            self.on_rendered(key[0], key[1])
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import multiprocessing
+from PyQt4 import QtCore
+from prefetcher import load_document, RESOLUTION, RENDER_HINT
+
+# manifest lives next to previews and keeps a fingerprint of every page
+# previews have been rendered from
+MANIFEST_NAME = "previews.json"
+MANIFEST_VERSION = 1
+PREVIEW_RESOLUTION = RESOLUTION
+PREVIEW_FORMAT = "png"
+# everything that affects the way previews look (these are the only params
+# _save_preview renders and saves with), previews rendered with other params
+# are never reused
+RENDER_PARAMS = {"resolution": PREVIEW_RESOLUTION,
+                 "format": PREVIEW_FORMAT,
+                 "hint": int(RENDER_HINT)}
+# resolution of a tiny render that is a part of page fingerprint
+FINGERPRINT_RESOLUTION = 9.0
+
+# every worker process has a Poppler document of its own, loaded once by
+# pool initializer
+_doc = None
+
+
+def _init_worker(filename):
+    global _doc
+    _doc = load_document(filename)
+
+
+# Poppler doesn't give access to page content stream, so page is identified by
+# its size, orientation, text and a tiny render (catches changes in images and
+# vector graphics)
+def page_fingerprint(page):
+    sha = hashlib.sha1()
+    size = page.pageSizeF()
+    sha.update(repr((size.width(), size.height(), int(page.orientation()))))
+    sha.update(unicode(page.text(QtCore.QRectF())).encode("utf-8"))
+    image = page.renderToImage(FINGERPRINT_RESOLUTION, FINGERPRINT_RESOLUTION)
+    sha.update(image.constBits().asstring(image.byteCount()))
+    return sha.hexdigest()
+
+
+# runs in worker process
+def _fingerprint(num):
+    return num, page_fingerprint(_doc.page(num))
+
+
+# renders page num and saves it to name, runs in worker process. QImages
+# can't be passed between processes, so result is written to disk right here
+def _save_preview(args):
+    num, name = args
+    _doc.page(num).renderToImage(PREVIEW_RESOLUTION, PREVIEW_RESOLUTION).\
+        save(name, PREVIEW_FORMAT)
+    return num, name
+
+
+# preview is considered up to date if it is not empty and has been written
+# after pdf was modified last time
+def is_up_to_date(name, pdf_mtime):
+    try:
+        stat = os.stat(name)
+    except OSError:
+        return False
+    return stat.st_size > 0 and stat.st_mtime >= pdf_mtime
+
+
+# Renders pages of pdf to png files in path in a pool of processes. Pages are
+# yielded one by one as soon as they are saved, so neither a whole book is
+# kept in memory nor one has to wait until the last page is ready to see a
+# progress. Only pages whose fingerprint differs from the one in manifest (or
+# whose previews have been changed on disk) are rendered again.
+class PreviewGenerator(object):
+    def __init__(self, filename, total_pages, prefix, path, processes=None):
+        self.filename = filename
+        self.total_pages = total_pages
+        self.prefix = prefix
+        self.path = path
+        self.processes = processes or multiprocessing.cpu_count()
+        # page number (1 for first page, as in filenames) -> manifest entry
+        self.pages = {}
+        self._fingerprints = {}
+        self._pool = None
+
+    @property
+    def manifest_name(self):
+        return os.path.join(self.path, MANIFEST_NAME)
+
+    def preview_name(self, num):
+        return os.path.join(self.path, self.prefix + str(num + 1))
+
+    # returns a list of (page num, filename) of pages that have to be
+    # (re)rendered. Fingerprinting of pages is reported to progress; if it is
+    # canceled, no jobs are returned
+    def jobs(self, progress=None):
+        manifest = self._load_manifest()
+        pdf_mtime = os.path.getmtime(self.filename)
+        jobs = []
+        if progress:
+            progress.setRange(0, self.total_pages)
+        for i, (num, fingerprint) in enumerate(self._get_pool().imap(
+                _fingerprint, range(0, self.total_pages), chunksize=8),
+                start=1):
+            if progress:
+                progress.setValue(i)
+                if progress.wasCanceled():
+                    # pages not checked keep their entries, changed ones
+                    # don't match them and will be rendered next time
+                    for key, entry in manifest.items():
+                        self.pages.setdefault(key, entry)
+                    return []
+            name = self.preview_name(num)
+            key = str(num + 1)
+            entry = manifest.get(key)
+            if entry is not None:
+                if entry["fingerprint"] == fingerprint and \
+                        self._is_intact(name, entry):
+                    self.pages[key] = entry
+                    continue
+            elif is_up_to_date(name, pdf_mtime):
+                # rendered before manifest has been introduced
+                self.pages[key] = self._entry(name, fingerprint)
+                continue
+            self._fingerprints[num] = fingerprint
+            jobs.append((num, name))
+        return jobs
+
+    # yields (page num, filename) of pages in order of completion
+    def generate(self, jobs):
+        if not jobs:
+            return
+        for num, name in self._get_pool().imap_unordered(_save_preview,
+                                                         jobs):
+            self.pages[str(num + 1)] = self._entry(name,
+                                                   self._fingerprints[num])
+            yield num, name
+
+    # saves manifest with whatever has been rendered so far and stops worker
+    # processes, must be called even if generation has been stopped halfway
+    def close(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._save_manifest()
+
+    def _get_pool(self):
+        if not self._pool:
+            self._pool = multiprocessing.Pool(self.processes, _init_worker,
+                                              (self.filename, ))
+        return self._pool
+
+    def _entry(self, name, fingerprint):
+        stat = os.stat(name)
+        return {"fingerprint": fingerprint,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime}
+
+    # True if preview is still the file manifest entry has been written for
+    def _is_intact(self, name, entry):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            return False
+        return stat.st_size == entry["size"] and \
+            stat.st_mtime == entry["mtime"]
+
+    # returns pages of manifest, empty dict if there is no manifest or
+    # previews have been rendered with other params
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_name) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION or \
+                manifest.get("render") != RENDER_PARAMS:
+            return {}
+        return manifest.get("pages", {})
+
+    def _save_manifest(self):
+        manifest = {"version": MANIFEST_VERSION,
+                    "render": RENDER_PARAMS,
+                    "pages": self.pages}
+        # manifest is replaced at once, never left half-written
+        tmp_name = self.manifest_name + ".tmp"
+        with open(tmp_name, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp_name, self.manifest_name)
@@ -10,8 +10,11 @@ class Settings(QtGui.QDialog):
         super(Settings, self).__init__()
         self.controller = controller
         self.parent = parent
+        # course loading goes on after settings are closed, so progress
+        # belongs to main window and doesn't block it
         self.progress = progress or QtGui.QProgressDialog(
-            u"Применение настроек...", u"Отмена", 0, 100, parent=self)
+            u"Применение настроек...", u"Отмена", 0, 100, parent=parent)
+        self.progress.setWindowModality(QtCore.Qt.NonModal)
         self.progress.setMinimumDuration(1)
         self.ui = Ui_Dialog()
         self.ui.setupUi(self)
@@ -101,23 +104,23 @@ class Settings(QtGui.QDialog):
             self.ui.cmsCourse_edit.setText(self.search_result[index - 1][0])
             self._enable_apply()
             # load starts right after course is chosen if no changes have been
-            # made
-            QtGui.QApplication.setOverrideCursor(
-                QtGui.QCursor(QtCore.Qt.BusyCursor))
+            # made. It goes on in background, lessons can be marked up as soon
+            # as they appear in toc
             self.progress.reset()
-            self.progress.open()
-            (course_loaded, any_errors) = self.controller.load_course(
-                self.chosen_course_id, self.display_name, self.progress)
-            # TODO figure out why won't it close by itself
-            self.progress.close()
-            QtGui.QApplication.restoreOverrideCursor()
-            if any_errors:
-                self._show_errors_in_course_dialog()
-                return
-            if course_loaded:
-                self.all_autozones = self.controller.all_autozones
-                self._let_modify_zonetypes(True)
-                self._set_correct_zones_text()
+            self.progress.show()
+            self.controller.load_course(
+                self.chosen_course_id, self.display_name, self.progress,
+                self._on_course_loaded)
+
+    def _on_course_loaded(self, course_loaded, any_errors):
+        self.progress.close()
+        if any_errors:
+            self._show_errors_in_course_dialog()
+            return
+        if course_loaded:
+            self.all_autozones = self.controller.all_autozones
+            self._let_modify_zonetypes(True)
+            self._set_correct_zones_text()
 
     # if any of the default values are not present in zoneslist, then remove
     # these values from lineedit text
@@ -210,6 +213,8 @@ class Settings(QtGui.QDialog):
         # disable apply
         self.apply_button.setEnabled(False)
         if self.controller.is_userdata_valid(self.login, self.password):
+            # ebook-defs might have been changed since they were retrieved
+            self.controller.invalidate_zone_types()
             if not self.ui.bookData_tab.isEnabled():
                 self.ui.incorrectData_label.hide()
                 self.ui.bookData_tab.setEnabled(True)
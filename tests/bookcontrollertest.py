@@ -36,9 +36,26 @@ class MockMark(object):
         x, y = self.pos
         return y
 
+    def pdf_y(self):
+        return self.y()
+
+    def set_origin_scale(self, scale):
+        pass
+
+    def set_scale(self, scale):
+        pass
+
     def set_page(self, page):
         self.page = page
 
+    def move(self, delta):
+        x, y = self.pos
+        delta_x, delta_y = delta
+        self.pos = (x + delta_x, y + delta_y)
+
+    def unbind_from_ruler(self):
+        pass
+
     def show(self):
         self.is_shown = True
         return "shown!"
@@ -94,6 +111,10 @@ class MockMark(object):
         x, y = self.pos
         return ([x, x + self.WIDTH], [y, y + self.HEIGHT])
 
+    def geometry_as_tuple(self):
+        x, y = self.pos
+        return (x, y, self.WIDTH, self.HEIGHT)
+
     def contains(self, point_tuple):
         x, y = point_tuple
         x_range, y_range = self.geometry()
@@ -556,6 +577,38 @@ class BookControllerTest(unittest.TestCase):
         self.assertTrue(inner_zone is not None)
         self.assertTrue(inner_zone.is_inner())
 
+    def test_postponed_validation(self):
+        start_data = {"pos": (0, 10),
+                      "parent": "MockParent",
+                      "cas_id": "lesson:bla-bla-bla",
+                      "page": 1,
+                      "delete_func": self.controller.delete_funcs["start_end"],
+                      "name": "lesson blablabla. Paragraph 2",
+                      "type": "start"}
+        end_data = {"pos": (0, 190),
+                    "parent": "MockParent",
+                    "cas_id": "lesson:bla-bla-bla",
+                    "page": 1,
+                    "delete_func": self.controller.delete_funcs["start_end"],
+                    "name": "lesson blablabla. Paragraph 2",
+                    "type": "end"}
+        start = self.controller.add_mark(start_data)
+        self.controller.add_mark(end_data)
+        self.toc_controller.select("lesson:bla-bla-bla")
+        self.toc_controller.states = {}
+        start.is_selected = True
+        # mark is moved while dragging, but toc state is left as is
+        self.controller.move((0, 5), (5, 20), validate=False)
+        self.assertEqual(start.y(), 15)
+        self.assertEqual(self.toc_controller.states, {})
+        self.controller.validate_moved()
+        self.assertEqual(self.toc_controller.states,
+                         {"lesson:bla-bla-bla": (True, False, False)})
+        # nothing is left to validate
+        self.toc_controller.states = {}
+        self.controller.validate_moved()
+        self.assertEqual(self.toc_controller.states, {})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+from bracketsvalidator import BracketsValidator
+
+
+class MockMark(object):
+    def __init__(self, cas_id, page, y, type):
+        self.cas_id = cas_id
+        self.page = page
+        self._y = y
+        self.type = type
+
+    def pdf_y(self):
+        return self._y
+
+    def is_start(self):
+        return self.type == "start"
+
+    def is_end(self):
+        return self.type == "end"
+
+
+# what BookController.verify_brackets did before: a full scan of all marks
+def verify_brackets(paragraphs):
+    stack = []
+    for pagenum in sorted(paragraphs.keys()):
+        for m in sorted(paragraphs[pagenum], key=lambda m: m.pdf_y()):
+            if m.is_start():
+                stack.append(m.cas_id)
+            elif m.is_end():
+                if not stack or stack[-1] != m.cas_id:
+                    return (False, m)
+                stack.pop()
+    return (True, None)
+
+
+class BracketsValidatorTest(unittest.TestCase):
+    def setUp(self):
+        super(BracketsValidatorTest, self).setUp()
+        self.validator = BracketsValidator()
+        self.paragraphs = {}
+
+    def _add(self, mark):
+        self.paragraphs.setdefault(mark.page, []).append(mark)
+        self.validator.add(mark)
+        return mark
+
+    def test_nested_paragraphs(self):
+        s1 = self._add(MockMark("lesson:1", 1, 10, "start"))
+        e1 = self._add(MockMark("lesson:1", 3, 50, "end"))
+        self.assertEqual(self.validator.validate(), (True, None))
+        s2 = self._add(MockMark("lesson:2", 2, 10, "start"))
+        e2 = self._add(MockMark("lesson:2", 4, 10, "end"))
+        self.assertEqual(self.validator.validate(), (False, e1))
+        # lesson 2 nested in lesson 1 is ok
+        e2.page = 3
+        e2._y = 40
+        self.validator.update(e2)
+        self.assertEqual(self.validator.validate(), (True, None))
+        # move lesson 2 after lesson 1
+        s2.page = 3
+        s2._y = 60
+        self.validator.update(s2)
+        e2.page = 4
+        self.validator.update(e2)
+        self.assertEqual(self.validator.validate(), (True, None))
+        self.validator.remove(s1)
+        self.assertEqual(self.validator.validate(), (False, e1))
+        self.validator.clear()
+        self.assertEqual(self.validator.validate(), (True, None))
+
+    # random adds, moves and deletes give the same result as a full scan
+    def test_same_as_full_scan(self):
+        rnd = random.Random(42)
+        marks = []
+        for i in xrange(2000):
+            action = rnd.random()
+            if action < 0.3 or not marks:
+                mark = self._add(MockMark("lesson:%d" % rnd.randint(1, 15),
+                                          rnd.randint(1, 20),
+                                          rnd.randint(0, 30),
+                                          rnd.choice(["start", "end"])))
+                marks.append(mark)
+            elif action < 0.9:
+                # marks are moved within their page, y might coincide
+                mark = rnd.choice(marks)
+                mark._y = rnd.randint(0, 30)
+                self.validator.update(mark)
+            else:
+                mark = marks.pop(rnd.randrange(len(marks)))
+                self.paragraphs[mark.page].remove(mark)
+                self.validator.remove(mark)
+            if rnd.random() < 0.5:
+                self.assertEqual(self.validator.validate(),
+                                 verify_brackets(self.paragraphs))
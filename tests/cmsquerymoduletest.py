@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import unittest
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from cmsquerymodule import CmsQueryModule, CmsQueryError, \
+    CmsQueryCanceledByUser
+
+
+# stands in for cms resolve url: answers with codes given, one per request,
+# and resolves all ids posted when codes are over
+class MockResolveHandler(BaseHTTPRequestHandler):
+    codes = []
+    # ids posted with every request
+    requests = []
+
+    def do_POST(self):
+        ids = json.loads(self.rfile.read(
+            int(self.headers.getheader("Content-Length"))))
+        MockResolveHandler.requests.append(ids)
+        code = MockResolveHandler.codes.pop(0) \
+            if MockResolveHandler.codes else 200
+        body = json.dumps({i: "name of %s" % i for i in ids}) \
+            if code == 200 else ""
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# progress dialog canceled by user
+class MockCanceledProgress(object):
+    def wasCanceled(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class CmsQueryModuleTest(unittest.TestCase):
+    def setUp(self):
+        super(CmsQueryModuleTest, self).setUp()
+        MockResolveHandler.codes = []
+        MockResolveHandler.requests = []
+        self.server = HTTPServer(("127.0.0.1", 0), MockResolveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.cache_dir = tempfile.mkdtemp()
+        url = "http://127.0.0.1:%d/" % self.server.server_port
+        with tempfile.NamedTemporaryFile(delete=False) as config:
+            for key, value in [("url", url),
+                               ("resolve-url", url + "resolve"),
+                               ("ping-url", url + "ping"),
+                               ("search-url", url + "search"),
+                               ("http-cache-dir", self.cache_dir),
+                               ("resolve-batch-size", "2")]:
+                config.write("%s = %s\n" % (key, value))
+        self.config_name = config.name
+        self.cqm = CmsQueryModule(self.config_name)
+        # no need to wait between retries here
+        self.cqm.RESOLVE_BACKOFF = 0
+        self.ids = ["lesson:%d" % i for i in range(5)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+        os.remove(self.config_name)
+
+    def _resolve(self):
+        return self.cqm._resolve_lesson_names(self.ids, u"user", u"pwd")
+
+    def test_batches(self):
+        self.assertEqual(self._resolve(),
+                         {i: "name of %s" % i for i in self.ids})
+        self.assertEqual(sorted(len(ids) for ids in
+                                MockResolveHandler.requests), [1, 2, 2])
+
+    def test_transient_error_retried(self):
+        self.ids = self.ids[:2]
+        MockResolveHandler.codes = [503, 200]
+        self.assertEqual(self._resolve(),
+                         {i: "name of %s" % i for i in self.ids})
+        self.assertEqual(MockResolveHandler.requests, [self.ids, self.ids])
+
+    def test_client_error_not_retried(self):
+        self.ids = self.ids[:2]
+        MockResolveHandler.codes = [404]
+        self.assertRaises(CmsQueryError, self._resolve)
+        self.assertEqual(len(MockResolveHandler.requests), 1)
+
+    def test_retries_limited(self):
+        self.ids = self.ids[:2]
+        MockResolveHandler.codes = [503] * (self.cqm.RESOLVE_RETRIES + 5)
+        self.assertRaises(CmsQueryError, self._resolve)
+        self.assertEqual(len(MockResolveHandler.requests),
+                         self.cqm.RESOLVE_RETRIES + 1)
+
+    def test_canceled(self):
+        MockResolveHandler.codes = [503] * (self.cqm.RESOLVE_RETRIES + 5)
+        self.assertRaises(CmsQueryCanceledByUser,
+                          self.cqm._resolve_lesson_names, self.ids[:2],
+                          u"user", u"pwd", MockCanceledProgress())
+        # no retries after cancel
+        self.assertEqual(len(MockResolveHandler.requests), 1)
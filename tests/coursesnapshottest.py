@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from coursesnapshot import save_snapshot, load_snapshot, SnapshotError
+from cmsquerymodule import CmsQueryModule
+from offlinecmsquerymodule import OfflineCmsQueryModule
+
+
+class CourseSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        super(CourseSnapshotTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.tmp_dir, "course.sqlite")
+        self.toc = [{"cas-id": "lesson:1", "name": u"Урок 1", "objects": []},
+                    {"cas-id": "lesson:2", "name": u"Урок 2",
+                     "objects": [{"oid": "195-010-00-01-dic",
+                                  "block-id": "block-1",
+                                  "rubric": "dict",
+                                  "name": u"Химия"},
+                                 {"oid": "195-010-01-02-task",
+                                  "block-id": "block-2",
+                                  "rubric": "task",
+                                  "name": u"Задание"}]}]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_and_load(self):
+        save_snapshot(self.snapshot, "course:123", u"Химия 8", self.toc,
+                      ["dic"], ["dic", "task"])
+        data = load_snapshot(self.snapshot)
+        self.assertEqual(data["course-id"], "course:123")
+        self.assertEqual(data["display-name"], u"Химия 8")
+        self.assertEqual(data["toc"], self.toc)
+        self.assertEqual(data["autozone-types"], ["dic"])
+        self.assertEqual(data["zone-types"], ["dic", "task"])
+        # snapshot is replaced as a whole
+        save_snapshot(self.snapshot, "course:456", u"Химия 9", self.toc[:1],
+                      [], [])
+        self.assertEqual(load_snapshot(self.snapshot)["toc"], self.toc[:1])
+        self.assertRaises(SnapshotError, load_snapshot,
+                          os.path.join(self.tmp_dir, "missing.sqlite"))
+
+    def test_query_module(self):
+        cqm = OfflineCmsQueryModule(u"tests/config-test")
+        toc, autozones = cqm.get_cms_course_toc("login", "password")
+        cqm.display_name = u"Демо"
+        cqm.export_snapshot(self.snapshot, "login", "password")
+        # course from snapshot is served without cms
+        cqm = OfflineCmsQueryModule(u"tests/config-test")
+        course_id = cqm.load_snapshot(self.snapshot)
+        self.assertEqual(cqm.get_cms_course_toc("login", "password",
+                                                course_id),
+                         (toc, autozones))
+        self.assertEqual(cqm.display_name, u"Демо")
+
+    def test_snapshot_per_course(self):
+        save_snapshot(self.snapshot, "course:123", u"Химия 8", self.toc,
+                      ["dic"], ["dic", "task"])
+        cqm = CmsQueryModule(u"tests/config-test")
+        self.assertEqual(cqm.load_snapshot(self.snapshot), "course:123")
+        self.assertEqual(cqm.get_cms_course_toc("login", "password",
+                                                "course:123"),
+                         (self.toc, ["dic"]))
+        self.assertEqual(cqm.get_zone_types("login", "password",
+                                            "course:123"), ["dic", "task"])
+        # other courses are not served from it
+        self.assertEqual(cqm._get_snapshot("course:456"), None)
+        # stale snapshot is dropped, course will be loaded from cms
+        cqm._snapshots["course:123"]["created"] -= cqm.snapshot_ttl
+        self.assertEqual(cqm._get_snapshot("course:123"), None)
+        self.assertEqual(cqm._snapshots, {})
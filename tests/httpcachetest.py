@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import unittest
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from curlpool import CurlPool
+from httpcache import HttpCache
+
+
+# stands in for cms: serves one document with an ETag and answers 304 to
+# conditional requests
+class MockCmsHandler(BaseHTTPRequestHandler):
+    body = "<lesson/>"
+    etag = '"v1"'
+    # (path, If-None-Match header) of every request served
+    requests = []
+
+    def do_GET(self):
+        inm = self.headers.getheader("If-None-Match")
+        MockCmsHandler.requests.append((self.path, inm))
+        if inm == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self):
+        super(HttpCacheTest, self).setUp()
+        MockCmsHandler.requests = []
+        MockCmsHandler.etag = '"v1"'
+        MockCmsHandler.body = "<lesson/>"
+        self.server = HTTPServer(("127.0.0.1", 0), MockCmsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/lesson:1" % self.server.server_port
+        self.cache_dir = tempfile.mkdtemp()
+        self.pool = CurlPool(http_cache=HttpCache(self.cache_dir))
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_revalidation(self):
+        self.assertEqual(self.pool.fetch(self.url, u"user", u"pwd",
+                                         cached=True),
+                         (200, "<lesson/>"))
+        # second time the body comes from disk
+        self.assertEqual(self.pool.fetch(self.url, u"user", u"pwd",
+                                         cached=True),
+                         (200, "<lesson/>"))
+        self.assertEqual([inm for (path, inm) in MockCmsHandler.requests],
+                         [None, '"v1"'])
+        # entries of different users don't mix
+        self.pool.fetch(self.url, u"other", u"pwd", cached=True)
+        self.assertEqual(MockCmsHandler.requests[-1][1], None)
+        # changed document is downloaded and cached again
+        MockCmsHandler.etag = '"v2"'
+        MockCmsHandler.body = "<lesson>new</lesson>"
+        self.assertEqual(self.pool.fetch_many([self.url], u"user", u"pwd",
+                                              cached=True),
+                         [(200, "<lesson>new</lesson>")])
+        self.assertEqual(self.pool.fetch(self.url, u"user", u"pwd",
+                                         cached=True),
+                         (200, "<lesson>new</lesson>"))
+        self.assertEqual(MockCmsHandler.requests[-1][1], '"v2"')
+
+    def test_not_cached(self):
+        self.pool.fetch(self.url, u"user", u"pwd")
+        self.pool.fetch(self.url, u"user", u"pwd")
+        # no conditional requests unless asked for
+        self.assertEqual([inm for (path, inm) in MockCmsHandler.requests],
+                         [None, None])
+
+    def test_non_ascii_url(self):
+        cache = HttpCache(self.cache_dir)
+        url = self.url.decode("utf-8") + u"/урок"
+        cache.put(url, u"user", {"etag": '"v1"'}, "<lesson/>")
+        self.assertEqual(cache.get(url, u"user"), "<lesson/>")
+        self.assertEqual(cache.conditional_headers(url, u"user"),
+                         ['If-None-Match: "v1"'])
+        cache.remove(url, u"user")
+        self.assertEqual(cache.get(url, u"user"), None)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+from markindex import MarkIndex
+
+
+# rect with QRect's notion of containing and intersecting
+class MockMark(object):
+    def __init__(self, x, y, w, h):
+        self.rect = (x, y, w, h)
+
+    def geometry_as_tuple(self):
+        return self.rect
+
+    def contains(self, point_tuple):
+        x, y, w, h = self.rect
+        px, py = point_tuple
+        return x <= px < x + w and y <= py < y + h
+
+    def intersects(self, rect_tuple):
+        x, y, w, h = self.rect
+        x1, y1, x2, y2 = rect_tuple
+        return x <= x2 and x1 < x + w and y <= y2 and y1 < y + h
+
+
+class MarkIndexTest(unittest.TestCase):
+    def test_first_match_wins(self):
+        zone = MockMark(0, 0, 40, 40)
+        inner = MockMark(10, 10, 10, 10)
+        index = MarkIndex([inner, zone])
+        self.assertEqual(index.find_at_point((15, 15)), inner)
+        self.assertEqual(index.find_at_point((35, 35)), zone)
+        self.assertEqual(index.find_at_point((45, 45)), None)
+        self.assertEqual(index.find_in_rect((38, 38, 50, 50)), zone)
+        # moved mark is found at its new place only
+        inner.rect = (100, 100, 10, 10)
+        index.update(inner)
+        self.assertEqual(index.find_at_point((15, 15)), zone)
+        self.assertEqual(index.find_at_point((105, 105)), inner)
+        # marks not in index are ignored
+        index.update(MockMark(0, 0, 1, 1))
+        self.assertEqual(len(index), 2)
+
+    # results are the same as of linear search
+    def test_same_as_linear_search(self):
+        rnd = random.Random(7)
+        marks = [MockMark(rnd.randint(0, 500), rnd.randint(0, 800),
+                          rnd.randint(5, 100), rnd.randint(5, 60))
+                 for i in xrange(200)]
+        index = MarkIndex(marks)
+        for i in xrange(500):
+            if rnd.random() < 0.3:
+                mark = rnd.choice(marks)
+                mark.rect = (rnd.randint(0, 500), rnd.randint(0, 800),
+                             mark.rect[2], mark.rect[3])
+                index.update(mark)
+            point = (rnd.randint(0, 600), rnd.randint(0, 900))
+            self.assertEqual(index.find_at_point(point),
+                             next((m for m in marks if m.contains(point)),
+                                  None))
+            rect = point + (point[0] + 5, point[1] + 5)
+            self.assertEqual(index.find_in_rect(rect),
+                             next((m for m in marks if m.intersects(rect)),
+                                  None))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import unittest
+from pagecache import PageCache
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        # values are strings here, cost is string's length
+        self.cache = PageCache(max_bytes=10, cost_func=len)
+
+    def test_lru_eviction(self):
+        self.assertEqual(self.cache.get((1, 1.0)), None)
+        self.assertEqual(self.cache.misses, 1)
+        self.cache.put((1, 1.0), "aaaa")
+        self.cache.put((2, 1.0), "bbbb")
+        self.assertEqual(self.cache.get((1, 1.0)), "aaaa")
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.total_bytes, 8)
+        # page 2 is the least recently used one and has to go
+        self.cache.put((3, 1.0), "cccc")
+        self.assertFalse((2, 1.0) in self.cache)
+        self.assertTrue((1, 1.0) in self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.total_bytes, 8)
+        # replacing an entry doesn't count it twice
+        self.cache.put((3, 1.0), "cc")
+        self.assertEqual(self.cache.total_bytes, 6)
+        # too big to be cached at all
+        self.cache.put((4, 1.0), "d" * 11)
+        self.assertFalse((4, 1.0) in self.cache)
+        self.assertEqual(len(self.cache), 2)
+        # rendering happens only on miss
+        rendered = []
+
+        def _render():
+            rendered.append(1)
+            return "eee"
+        self.cache.get_or_render((5, 2.0), _render)
+        self.cache.get_or_render((5, 2.0), _render)
+        self.assertEqual(len(rendered), 1)
+        # shrinking the budget evicts immediately
+        self.cache.set_max_bytes(3)
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue((5, 2.0) in self.cache)
+
+    def test_invalidate(self):
+        self.cache.put((1, 1.0), "a")
+        self.cache.put((1, 2.0), "bb")
+        self.cache.put((2, 1.0), "c")
+        self.cache.invalidate_page(1)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.total_bytes, 1)
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.total_bytes, 0)
+        self.assertEqual(self.cache.stats["entries"], 0)
@@ -76,3 +76,26 @@ class ParagraphMarkTest(unittest.TestCase):
         self.assertTrue(start.is_start())
         self.assertTrue(pass_zone.is_passthrough_zone())
         self.assertTrue(hor_ruler.is_ruler())
+
+    # geometry is kept in pdf coordinates, so zooming in and out many times
+    # never makes marks drift
+    def test_zoom_cycle(self):
+        app = QtGui.QApplication.instance() or QtGui.QApplication([])
+        mock_parent = QtGui.QLabel()
+        start = make_paragraph_mark(pos=(34, 36), parent=mock_parent,
+                                    cas_id="lesson:123", page=15,
+                                    delete_func=lambda x: x, name="start",
+                                    type="start")
+        # created on a page shown in scale 1.5
+        start.set_origin_scale(1.5)
+        geometry = start.geometry()
+        pdf_y = start.pdf_y()
+        self.assertEqual(pdf_y, 24)
+        for scale in [2.0, 3.3, 1.0, 4.7, 2.5, 1.5]:
+            start.set_scale(scale)
+        self.assertEqual(start.geometry(), geometry)
+        self.assertEqual(start.pdf_y(), pdf_y)
+        # moves on screen are scaled down to pdf
+        start.set_scale(2.0)
+        start.move((0, 10))
+        self.assertEqual(start.pdf_y(), pdf_y + 5)
@@ -23,6 +23,8 @@ class MockTocElem(object):
 class MockTocController(object):
     def __init__(self):
         self.active_elem = None
+        # cas_id -> last set_state args, not present in real Toc Controller
+        self.states = {}
 
     @property
     def is_anything_selected(self):
@@ -37,7 +39,7 @@ class MockTocController(object):
         return None
 
     def set_state(self, value, cas_id, is_ok=False, braces_err=False):
-        pass
+        self.states[cas_id] = (value, is_ok, braces_err)
 
     def set_default_state(self, cas_id):
         pass
@@ -73,6 +75,12 @@ class MockTocController(object):
     def reload_course(self, course_id, start, end):
         print("Course {} reloaded").format(course_id)
 
+    def begin_course(self, toc, start, end):
+        pass
+
+    def add_lesson(self, index, lesson):
+        pass
+
 class TocControllerTest(unittest.TestCase):
     def setUp(self):
         super(TocControllerTest, self).setUp()
@@ -51,6 +51,17 @@ class TocController(object):
         self.toc_elems = []
         # course toc elems that appear in markup mode (QMarkerTocElem's list)
         self.markup_toc_elems = []
+        # cas_id -> elem indexes of toc_elems and markup_toc_elems and
+        # (cas_id, zone_id) -> QZone index, kept in sync by create_toc_elems
+        # and add_lesson
+        self._sections_index = {}
+        self._markup_index = {}
+        self._zones_index = {}
+        # (start, end) autozones of course being loaded
+        self._autozones = (start_autozones, end_autozones)
+        # bumped by every method changing elems' states, so that views
+        # depending on states (error console etc) can tell when to refresh
+        self.state_version = 0
         # currently selected element (QTocElem or QZone) is stored here
         self.current_toc_elem = None
         self.pagenum_func = None
@@ -106,7 +117,36 @@ class TocController(object):
         else:
             return self.markup_toc_elems
 
+    # Streaming course load: begin_course is called when lesson names are
+    # known and fills sections view at once, markup elems are appended by
+    # add_lesson one by one (in TOC order) as lessons are downloaded
+    def begin_course(self, new_toc, new_start, new_end):
+        self.course_toc = new_toc
+        self._autozones = (new_start, new_end)
+        self.fill_with_data(self.MODE_SECTIONS, new_start, new_end)
+        self.fill_with_data(self.MODE_MARKUP, new_start, new_end, toc=[])
+
+    def add_lesson(self, index, lesson):
+        self.state_version = self.state_version + 1
+        (start_autozones, end_autozones) = self._autozones
+        self.course_toc[index] = lesson
+        mtoc = QMarkerTocElem(lesson["name"], lesson["cas-id"],
+                              lesson["objects"], start_autozones,
+                              end_autozones)
+        self.markup_toc_elems.append(mtoc)
+        self._index_markup_elem(mtoc)
+        self.markup_view.model().appendRow(mtoc)
+        mtoc.set_not_started()
+        # marks might have been placed while lesson was downloading
+        toc_elem = self._get_sections_elem(mtoc.cas_id)
+        finished = toc_elem is not None and toc_elem.is_finished()
+        if finished:
+            mtoc._set_selectable(True)
+        self.markup_view.setRowHidden(mtoc.index().row(),
+                                      mtoc.index().parent(), not finished)
+
     def reload_course(self, new_toc, new_start, new_end, zones_only=False):
+        self.state_version = self.state_version + 1
         self.course_toc = new_toc
         if not zones_only:
             self.fill_with_data(self.MODE_SECTIONS, new_start, new_end)
@@ -134,6 +174,7 @@ class TocController(object):
     # is in FINISHED state and markup elem can be selected)
     def set_state(self, both_ends, cas_id=None, mixed_up=False,
                            brackets_err=False):
+        self.state_version = self.state_version + 1
         cas_id = cas_id if cas_id else self.current_toc_elem
         if cas_id:
             if not self._get_sections_elem(cas_id):
@@ -149,22 +190,29 @@ class TocController(object):
             # markup elems can be selected ONLY if appropriate start\end
             # have been set
             mtoc = self._get_markup_elem(cas_id)
+            if not mtoc:
+                # lesson is still loading, state is applied in add_lesson
+                return
             if value:
                 mtoc._set_selectable(True)
             self.markup_view.setRowHidden(mtoc.index().row(),
                                           mtoc.index().parent(), not value)
 
     def set_default_state(self, cas_id=None):
+        self.state_version = self.state_version + 1
         cas_id = self.current_toc_elem.cas_id \
             if self.current_toc_elem else cas_id
         if not self._get_sections_elem(cas_id):
             return
         if cas_id:
             self._get_sections_elem(cas_id).set_not_started()
-            self._get_markup_elem(cas_id).set_not_started()
+            mtoc = self._get_markup_elem(cas_id)
+            if mtoc:
+                mtoc.set_not_started()
         self.current_toc_elem = None
 
     def set_default_style(self):
+        self.state_version = self.state_version + 1
         for e in self.toc_elems:
             e.set_not_started()
         for e in self.markup_toc_elems:
@@ -173,24 +221,40 @@ class TocController(object):
     # returns a list of QTocElems (to fill a listView, for example)
     # has to return a new list all the time as items are owned by a model and
     # by calling
-    def create_toc_elems(self, mode, start_autozones, end_autozones):
+    # toc is course_toc unless given
+    def create_toc_elems(self, mode, start_autozones, end_autozones,
+                         toc=None):
+        toc = self.course_toc if toc is None else toc
         if mode == self.MODE_SECTIONS:
             self.toc_elems = \
                 [ QTocElem(elem["name"], elem["cas-id"]) \
-                for elem in self.course_toc ]
+                for elem in toc ]
+            self._sections_index = {}
+            for elem in self.toc_elems:
+                self._sections_index.setdefault(elem.cas_id, elem)
             return self.toc_elems
         else:
             self.markup_toc_elems = \
                 [ QMarkerTocElem(elem["name"], elem["cas-id"],
                                  elem["objects"], start_autozones, end_autozones)
-                for elem in self.course_toc ]
+                for elem in toc ]
+            self._markup_index = {}
+            self._zones_index = {}
+            for elem in self.markup_toc_elems:
+                self._index_markup_elem(elem)
             return self.markup_toc_elems
 
+    # the first elem\zone with a given key wins, as it did with linear search
+    def _index_markup_elem(self, mtoc):
+        self._markup_index.setdefault(mtoc.cas_id, mtoc)
+        for zone in mtoc.zones:
+            self._zones_index.setdefault((mtoc.cas_id, zone.zone_id), zone)
+
     # finds zone in given lesson (cas_id) with given zone_id
     def get_zone_toc_elem(self, cas_id, zone_id):
         toc_elem = self._get_markup_elem(cas_id)
         if toc_elem:
-            return toc_elem.get_zone(zone_id)
+            return self._zones_index.get((toc_elem.cas_id, zone_id))
         else:
             print "NO TOC ELEM FOR %s" % cas_id
 
@@ -222,9 +286,9 @@ class TocController(object):
 
     def get_autoplaced_zones(self, cas_id, icons_producer):
         # verify that everything ok with start\end
-        if self._get_sections_elem(cas_id).is_finished():
-            return self._get_markup_elem(cas_id).\
-                get_autozones_as_dict(icons_producer)
+        mtoc = self._get_markup_elem(cas_id)
+        if mtoc and self._get_sections_elem(cas_id).is_finished():
+            return mtoc.get_autozones_as_dict(icons_producer)
         return []
 
     def get_view_widget(self, mode):
@@ -239,7 +303,9 @@ class TocController(object):
             autotypes.update(mtoc_elem.autotypes)
         return autotypes
 
-    def fill_with_data(self, mode, start_autozones, end_autozones):
+    def fill_with_data(self, mode, start_autozones, end_autozones, toc=None):
+        # all elems are created anew in default state
+        self.state_version = self.state_version + 1
         view = self.get_view_widget(mode)
         view.reset()
         model = view.model()
@@ -247,7 +313,8 @@ class TocController(object):
             model.clear()
         else:
             model = QtGui.QStandardItemModel()
-        for item in self.create_toc_elems(mode, start_autozones, end_autozones):
+        for item in self.create_toc_elems(mode, start_autozones, end_autozones,
+                                          toc):
             model.appendRow(item)
             item.set_not_started()
         view.setModel(model)
@@ -289,11 +356,13 @@ class TocController(object):
             self.current_toc_elem = current
 
     def process_zone_added(self, zone):
+        self.state_version = self.state_version + 1
         zone_elem = self.get_zone_toc_elem(zone.cas_id, zone.zone_id)
         if zone_elem:
             zone_elem.set_finished(True)
 
     def process_zone_deleted(self, zone):
+        self.state_version = self.state_version + 1
         zone_elem = self.get_zone_toc_elem(zone.cas_id, zone.zone_id)
         if zone_elem:
             zone_elem.set_finished(False)
@@ -366,10 +435,8 @@ class TocController(object):
 
     # finds toc elem ordernum by cas_id and returns corresponding QMarkerTocElem
     def _get_sections_elem(self, cas_id):
-        return next((elem for elem in self.toc_elems \
-                     if elem.cas_id == cas_id), None)
+        return self._sections_index.get(cas_id)
 
     # finds toc elem ordernum by cas_id and returns corresponding QMarkerTocElem
     def _get_markup_elem(self, cas_id):
-        return next((elem for elem in self.markup_toc_elems \
-                     if elem.cas_id == cas_id), None)
+        return self._markup_index.get(cas_id)